@@ -21,8 +21,10 @@
 import argparse
 import errno
 import os
+import shutil
 import sqlalchemy
 import sys
+import tempfile
 import warnings
 import xdg.BaseDirectory  # pyxdg, apt:python-xdg
 
@@ -33,16 +35,25 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import SingletonThreadPool
 from uuid import UUID
 
-from .platform.btrfs import find_new, get_root_generation
+from .platform.btrfs import (
+    find_new, get_root_generation, DEFAULT_TREE_SEARCH_BUF_SIZE)
 from .platform.ioprio import set_idle_priority
 from .platform.syncfs import syncfs
 
+from .blocks import dedup_blocks
 from .dedup import dedup_same, FilesInUseError
 from .filesystem import show_vols, WholeFS
+from .hashing import MiniHashSampler, DEFAULT_INTERIOR_SAMPLES
 from .migrations import upgrade_schema
-from .termupdates import TermTemplate
+from .reading import (
+    bench_read, page_cache_size, DEFAULT_READ_BUFFER_SIZE,
+    DEFAULT_READ_STRATEGY, READ_STRATEGIES)
+from .termupdates import format_duration, TermTemplate
+from .throttle import (
+    install_signal_handlers, PressureMonitor, ReadThrottle)
 from .tracking import (
-    track_updated_files, dedup_tracked, reset_vol, fake_updates)
+    track_updated_files, track_updated_vols, dedup_tracked, reset_vol,
+    fake_updates, bench_upserts)
 
 
 APP_NAME = 'bedup'
@@ -62,7 +73,9 @@ def cmd_find_new(args):
         sep = '\0'
     else:
         sep = '\n'
-    find_new(volume_fd, args.generation, sys.stdout, terse=args.terse, sep=sep)
+    find_new(
+        volume_fd, args.generation, sys.stdout, terse=args.terse, sep=sep,
+        buf_size=args.search_buf_size)
 
 
 def cmd_show_vols(args):
@@ -114,6 +127,15 @@ def vol_cmd(args):
     elif args.command == 'reset' and not args.filter:
         sys.stderr.write("You need to list volumes explicitly.\n")
         return 1
+    if (
+        args.command == 'dedup' and args.per_device_reads
+        and args.read_order == 'physical'
+    ):
+        # The elevator reads from a single thread
+        sys.stderr.write(
+            "--per-device-reads and --read-order=physical "
+            "can't be combined.\n")
+        return 1
 
     with ExitStack() as stack:
         tt = stack.enter_context(closing(TermTemplate()))
@@ -167,20 +189,87 @@ def vol_cmd(args):
                     tt.format('{elapsed} Flushing %s' % (vol,))
                     syncfs(vol.fd)
                     tt.format(None)
-                track_updated_files(sess, vol, tt)
+                if args.jobs <= 1:
+                    track_updated_files(
+                        sess, vol, tt, search_buf_size=args.search_buf_size,
+                        scan_extents=args.scan_extents)
                 vols_by_fs[vol.fs].append(vol)
+            if args.jobs > 1:
+                track_updated_vols(
+                    sess, vols, tt, args.jobs,
+                    search_buf_size=args.search_buf_size,
+                    scan_extents=args.scan_extents)
 
         if args.command == 'dedup':
+            cached_before = page_cache_size()
+            pressure = PressureMonitor(dict(
+                io=args.max_io_pressure, memory=args.max_memory_pressure))
+            for resource in pressure.unavailable:
+                tt.notify(
+                    'The kernel doesn\'t report %s pressure, '
+                    'ignoring its threshold' % resource)
+            throttle = ReadThrottle(
+                args.max_read_rate, args.max_iops, pressure)
+            install_signal_handlers(throttle)
             if args.groupby == 'vol':
                 for vol in vols:
                     tt.notify('Deduplicating volume %s' % vol)
-                    dedup_tracked(sess, [vol], tt)
+                    dedup_tracked(
+                        sess, [vol], tt, hash_threads=args.hash_threads,
+                        read_buffer_size=args.read_buffer_size,
+                        sampler=MiniHashSampler(
+                            args.mini_hash_samples, throttle=throttle),
+                        backend=args.dedup_backend,
+                        csum_fingerprints=args.csum_fingerprints,
+                        read_strategy=args.read_strategy, throttle=throttle,
+                        read_order=args.read_order,
+                        per_device_reads=args.per_device_reads,
+                        proc_scan_interval=args.proc_scan_interval)
+                    if args.blocks:
+                        dedup_blocks(
+                            sess, [vol], tt,
+                            read_buffer_size=args.read_buffer_size,
+                            backend=args.dedup_backend,
+                            read_strategy=args.read_strategy,
+                            throttle=throttle,
+                            proc_scan_interval=args.proc_scan_interval)
             elif args.groupby == 'mpoint':
                 for fs, volset in vols_by_fs.iteritems():
                     tt.notify('Deduplicating filesystem %s' % fs)
-                    dedup_tracked(sess, volset, tt)
+                    dedup_tracked(
+                        sess, volset, tt, hash_threads=args.hash_threads,
+                        read_buffer_size=args.read_buffer_size,
+                        sampler=MiniHashSampler(
+                            args.mini_hash_samples, throttle=throttle),
+                        backend=args.dedup_backend,
+                        csum_fingerprints=args.csum_fingerprints,
+                        read_strategy=args.read_strategy, throttle=throttle,
+                        read_order=args.read_order,
+                        per_device_reads=args.per_device_reads,
+                        proc_scan_interval=args.proc_scan_interval)
+                    if args.blocks:
+                        dedup_blocks(
+                            sess, volset, tt,
+                            read_buffer_size=args.read_buffer_size,
+                            backend=args.dedup_backend,
+                            read_strategy=args.read_strategy,
+                            throttle=throttle,
+                            proc_scan_interval=args.proc_scan_interval)
             else:
                 assert False, args.groupby
+            cached_after = page_cache_size()
+            if cached_before is not None and cached_after is not None:
+                # Other programs also affect this
+                tt.notify(
+                    'Page cache changed by %+d KiB during deduplication '
+                    '(%s reads)' % (
+                        (cached_after - cached_before) // 1024,
+                        args.read_strategy))
+            if pressure.pauses:
+                tt.notify(
+                    'Paused %d times for %s because of pressure' % (
+                        pressure.pauses,
+                        format_duration(pressure.paused_time)))
 
         # For safety only.
         # The methods we call from the tracking module are expected to commit.
@@ -251,6 +340,38 @@ def cmd_shell(args):
         embed()
 
 
+def cmd_bench_read(args):
+    for desc, elapsed, size in bench_read(
+        args.files, args.buf_sizes, args.repeat, args.read_strategy
+    ):
+        print('%-32s %8.3fs %10.1f MiB/s' % (
+            desc, elapsed, size / max(elapsed, 1e-6) / 1024 ** 2))
+
+
+def cmd_bench_upserts(args):
+    tmp_dir = tempfile.mkdtemp(prefix='bedup-bench-')
+    dbs = []
+
+    def make_session():
+        db_path = os.path.join(tmp_dir, 'db%d.sqlite' % len(dbs))
+        dbs.append(db_path)
+        url = sqlalchemy.engine.url.URL('sqlite', database=db_path)
+        engine = sqlalchemy.engine.create_engine(
+            url, echo=args.verbose_sql, poolclass=SingletonThreadPool)
+        sqlalchemy.event.listen(engine, 'connect', sql_setup)
+        upgrade_schema(engine, False)
+        return sessionmaker(bind=engine)()
+
+    try:
+        for desc, elapsed, count in bench_upserts(
+            make_session, args.count, args.repeat
+        ):
+            print('%-32s %8.3fs %10d inodes/s' % (
+                desc, elapsed, count / max(elapsed, 1e-6)))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
 def cmd_fake_updates(args):
     sess = get_session(args)
     faked = fake_updates(sess, args.max_events)
@@ -287,11 +408,119 @@ def vol_flags(parser):
         'This may be useful with pre-3.6 kernels.')
 
 
+def search_flags(parser):
+    parser.add_argument(
+        '--search-buf-size', type=int, dest='search_buf_size',
+        default=DEFAULT_TREE_SEARCH_BUF_SIZE, metavar='BYTES',
+        help='Size of the result buffer for tree searches (up to 16MiB, '
+        'Linux 3.16 or newer; older kernels use a 4KiB buffer). '
+        'Scans report the number of search ioctls used.')
+
+
 def scan_flags(parser):
     vol_flags(parser)
+    search_flags(parser)
     parser.add_argument(
         '--flush', action='store_true', dest='flush',
         help='Flush outstanding data using syncfs before scanning volumes')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1, dest='jobs', metavar='N',
+        help='Scan up to N volumes concurrently')
+    parser.add_argument(
+        '--scan-extents', action='store_true', dest='scan_extents',
+        help='Also read the extent items of updated files, so that files '
+        'that already share their data are recognised without opening them')
+
+
+def dedup_flags(parser):
+    scan_flags(parser)
+    parser.add_argument(
+        '--hash-threads', type=int, default=1, dest='hash_threads',
+        metavar='N',
+        help='Read and hash up to N candidate files concurrently')
+    parser.add_argument(
+        '--mini-hash-samples', type=int, dest='mini_hash_samples',
+        default=DEFAULT_INTERIOR_SAMPLES, metavar='N',
+        help='Sample N blocks between the head and tail of files '
+        'for the quick first comparison.  Changing this discards '
+        'the stored samples.')
+    parser.add_argument(
+        '--dedup-backend', choices=('clone', 'extent-same'), default='clone',
+        dest='dedup_backend',
+        help='clone: lock files in userspace, compare them, then clone; '
+        'extent-same: let the kernel compare and share the data '
+        '(Linux 3.12 or newer, falls back to clone otherwise)')
+    parser.add_argument(
+        '--read-order', choices=('inode', 'physical'), default='inode',
+        dest='read_order',
+        help='inode: hash candidate files one after the other; '
+        'physical: interleave their chunks in on-disk order, '
+        'to limit seeking on rotating disks (ignores --hash-threads).  '
+        'Lockstep comparisons of small groups read each round in '
+        'on-disk order, and files are compared with the source in '
+        'the order of their first extent; each comparison still '
+        'alternates between the two files.')
+    parser.add_argument(
+        '--per-device-reads', action='store_true', dest='per_device_reads',
+        help='On multi-device filesystems, read files from every device '
+        'at once, one thread per device (replaces --hash-threads).  '
+        'Files are read from the device holding most of their data.  '
+        'Can\'t be combined with --read-order=physical.')
+    parser.add_argument(
+        '--proc-scan-interval', type=float, default=0,
+        dest='proc_scan_interval', metavar='SECONDS',
+        help='Reuse the scan of open files in /proc for this long.  '
+        'Files opened for writing since the last scan are missed; '
+        'the default is to scan before locking every group of files.')
+    parser.add_argument(
+        '--csum-fingerprints', action='store_true',
+        dest='csum_fingerprints',
+        help='Group candidates by the data checksums btrfs keeps, '
+        'instead of reading and hashing them.  Files are still compared '
+        'before deduplication.  Compressed or nodatasum files are hashed.')
+    parser.add_argument(
+        '--blocks', action='store_true',
+        help='Also share identical 128KiB blocks between files that '
+        'differ elsewhere.  Keeps a digest of every block of '
+        'tracked files.')
+    read_flags(parser)
+
+
+def read_flags(parser):
+    parser.add_argument(
+        '--read-buffer-size', type=int, dest='read_buffer_size',
+        default=DEFAULT_READ_BUFFER_SIZE, metavar='BYTES',
+        help='Size of the buffers used to hash and compare files '
+        '(a multiple of 4KiB, up to 64MiB)')
+    read_strategy_flag(parser)
+    parser.add_argument(
+        '--max-read-rate', type=int, dest='max_read_rate', metavar='BYTES',
+        help='Read at most BYTES per second on average.  Send SIGUSR1 to '
+        'halve the limits (setting this one from the current rate if '
+        'there is none), SIGUSR2 to double them.')
+    parser.add_argument(
+        '--max-iops', type=int, dest='max_iops', metavar='N',
+        help='Issue at most N read calls per second on average')
+    parser.add_argument(
+        '--max-io-pressure', type=float, dest='max_io_pressure',
+        metavar='PERCENT',
+        help='Pause while some tasks were stalled on I/O more than '
+        'PERCENT of the last 10 seconds (Linux PSI)')
+    parser.add_argument(
+        '--max-memory-pressure', type=float, dest='max_memory_pressure',
+        metavar='PERCENT',
+        help='Pause while some tasks were stalled on memory more than '
+        'PERCENT of the last 10 seconds (Linux PSI)')
+
+
+def read_strategy_flag(parser):
+    parser.add_argument(
+        '--read-strategy', choices=READ_STRATEGIES,
+        default=DEFAULT_READ_STRATEGY, dest='read_strategy',
+        help='cached: plain reads; '
+        'fadvise: drop the file data we brought into the page cache; '
+        'direct: bypass the page cache with O_DIRECT.  '
+        'The last two keep other programs\' data cached.')
 
 
 def is_in_path(cmd):
@@ -319,7 +548,7 @@ Scans volumes to keep track of potentially duplicated files.""")
         'dedup', help='Scan and deduplicate', description="""
 Runs scan, then deduplicates identical files.""")
     sp_dedup_vol.set_defaults(action=vol_cmd)
-    scan_flags(sp_dedup_vol)
+    dedup_flags(sp_dedup_vol)
 
     # An alias so as not to break btrfs-time-machine.
     # No help; which should make it (mostly) invisible.
@@ -327,7 +556,7 @@ Runs scan, then deduplicates identical files.""")
         'dedup-vol', description="""
 A deprecated alias for the 'dedup' command.""")
     sp_dedup_vol_compat.set_defaults(action=vol_cmd)
-    scan_flags(sp_dedup_vol_compat)
+    dedup_flags(sp_dedup_vol_compat)
 
     sp_reset_vol = commands.add_parser(
         'reset', help='Reset tracking metadata', description="""
@@ -354,6 +583,7 @@ modified to include directories as well.""")
         help='use a NUL character as the line separator')
     sp_find_new.add_argument(
         '--terse', dest='terse', action='store_true', help='print names only')
+    search_flags(sp_find_new)
     sp_find_new.add_argument('volume', help='volume to search')
     sp_find_new.add_argument(
         'generation', type=int, nargs='?', default=0,
@@ -405,6 +635,37 @@ Fake inode updates from the latest dedup events (useful for benchmarking).""")
     sp_fake_updates.add_argument('max_events', type=int)
     sql_flags(sp_fake_updates)
 
+    sp_bench_read = commands.add_parser(
+        'bench-read', description="""
+Time hashing and comparing files with various read buffer sizes
+(useful for benchmarking).  Runs after the first use the page cache,
+drop caches in between to measure cold reads.""")
+    sp_bench_read.set_defaults(action=cmd_bench_read)
+    sp_bench_read.add_argument(
+        'files', metavar='FILE', nargs='+',
+        help='files to read; the first two are also compared')
+    sp_bench_read.add_argument(
+        '--buf-sizes', type=int, nargs='+', dest='buf_sizes',
+        default=[64 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2],
+        metavar='BYTES')
+    sp_bench_read.add_argument(
+        '--repeat', type=int, default=3, help='keep the best of N runs')
+    read_strategy_flag(sp_bench_read)
+
+    sp_bench_upserts = commands.add_parser(
+        'bench-upserts', description="""
+Time recording scanned inodes in the database, one at a time through
+the ORM and in batches, on synthetic inodes in a temporary database
+(useful for benchmarking).""")
+    sp_bench_upserts.set_defaults(action=cmd_bench_upserts)
+    sp_bench_upserts.add_argument(
+        '--count', type=int, default=100000, help='inodes per scan')
+    sp_bench_upserts.add_argument(
+        '--repeat', type=int, default=3, help='keep the best of N runs')
+    sp_bench_upserts.add_argument(
+        '--verbose-sql', action='store_true', dest='verbose_sql',
+        help='print sql statements being executed')
+
     args = parser.parse_args(argv[1:])
     if args.debug:
         try:
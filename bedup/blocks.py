@@ -0,0 +1,361 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Block-level deduplication.
+
+Tracked files are cut into aligned BLOCK_SIZE blocks, whose digests are
+kept in the BlockDigest table.  Blocks that match a block of another
+file are merged into ranges, which are then deduplicated with
+clone_range (after locking and comparing) or extent-same.
+"""
+
+import errno
+import hashlib
+
+from collections import defaultdict, namedtuple
+from contextlib import closing
+from contextlib2 import ExitStack
+from sqlalchemy.sql import and_, or_, select
+
+from .datetime import system_now
+from .dedup import ImmutableFDs, ProcFdIndex
+from .model import BlockDigest, DedupEvent, DedupEventInode, Inode
+from .platform.btrfs import (
+    clone_range, extent_same, has_extent_same, lookup_ino_path_one)
+from .platform.fiemap import fiemap, lib as fiemap_lib
+from .platform.openat import fopenat, fopenat_rw
+from .platform.pread import ffi, memeq
+from .reading import (
+    Reader, data_regions, DEFAULT_READ_BUFFER_SIZE, DEFAULT_READ_STRATEGY)
+from .tracking import forget_block_digests, forget_inode
+
+
+BLOCK_SIZE = 128 * 1024
+
+# Digests per IN query, below SQLite's limit on bound variables
+QUERY_BATCH_SIZE = 500
+
+
+# A range of dest that has the same contents as a range of src
+BlockRange = namedtuple(
+    'BlockRange', 'dest_offset src_vol_id src_ino src_offset length')
+
+
+def block_digest(data):
+    # 60 bits, so that it fits a signed SQLite integer
+    return int(hashlib.sha1(data).hexdigest()[:15], 16)
+
+
+def iter_block_digests(reader, fd, size, block_size=BLOCK_SIZE):
+    """Yields (offset, digest) for the blocks of a file.
+
+    Holes, blocks of zeroes and a partial last block are skipped.
+    reader.buf_size must be a multiple of block_size.
+    """
+
+    zeros = ffi.new('char[]', block_size)
+    full_end = size - size % block_size
+    offset = 0
+    for start, end in data_regions(fd, size):
+        start = max(offset, start - start % block_size)
+        end = min(full_end, end + -end % block_size)
+        offset = start
+        for cbuf, count in reader.chunks(fd, start, end):
+            for pos in xrange(0, count - count % block_size, block_size):
+                block = cbuf + pos
+                if not memeq(block, zeros, block_size):
+                    yield offset + pos, block_digest(
+                        ffi.buffer(block, block_size))
+            offset += count
+        offset = max(offset, end)
+
+
+def digest_blocks(sess, vols_by_id, tt, reader):
+    """Digests the blocks of inodes modified since they were last digested.
+
+    Returns the (vol_id, ino) pairs that were digested,
+    and the set of their digests.
+    """
+
+    block = BlockDigest.__table__
+    inodes = sess.query(Inode).filter(
+        Inode.vol_id.in_(vols_by_id.keys()),
+        Inode.transid != None,
+        or_(Inode.block_transid == None,
+            Inode.block_transid != Inode.transid)).all()
+
+    tt.format(
+        '{elapsed} Digested blocks of {bfile:counter}/{bfile:total} files '
+        '{read_rate}')
+    tt.set_total(bfile=len(inodes))
+    updated = set()
+    digests = set()
+    for inode in inodes:
+        tt.update(bfile=None)
+        if reader.throttle is not None:
+            tt.update(read_rate=reader.throttle.describe())
+            reader.throttle.pause()
+        vol = vols_by_id[inode.vol_id]
+        try:
+            pathb = vol.lookup_one_path(inode)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            forget_inode(sess, inode)
+            sess.commit()
+            continue
+        with closing(fopenat(vol.fd, pathb)) as rfile:
+            if inode.is_reused_by(rfile):
+                forget_inode(sess, inode)
+                sess.commit()
+                continue
+            rows = [
+                dict(vol_id=inode.vol_id, ino=inode.ino,
+                     offset=offset, digest=digest)
+                for offset, digest in iter_block_digests(
+                    reader, rfile.fileno(), inode.size)]
+        sess.execute(block.delete().where(and_(
+            block.c.vol_id == inode.vol_id, block.c.ino == inode.ino)))
+        if rows:
+            sess.execute(block.insert(), rows)
+        inode.block_transid = inode.transid
+        sess.commit()
+        updated.add((inode.vol_id, inode.ino))
+        digests.update(row['digest'] for row in rows)
+    tt.format(None)
+    return updated, digests
+
+
+def find_ranges(sess, vol_ids, updated, digests):
+    """Matches the blocks with the given digests.
+
+    Every block is matched to one source block with the same digest,
+    preferably one that was digested before (others may already share
+    it).  Pairs that were both digested before were handled then.
+    Returns a list of BlockRange per destination (vol_id, ino).
+    """
+
+    block = BlockDigest.__table__
+    matches = defaultdict(list)
+    digests = sorted(digests)
+    for i in xrange(0, len(digests), QUERY_BATCH_SIZE):
+        by_digest = defaultdict(list)
+        for row in sess.execute(select([
+            block.c.vol_id, block.c.ino, block.c.offset, block.c.digest,
+        ]).where(and_(
+            block.c.vol_id.in_(vol_ids),
+            block.c.digest.in_(digests[i:i + QUERY_BATCH_SIZE]),
+        ))):
+            by_digest[row.digest].append((row.vol_id, row.ino, row.offset))
+        for members in by_digest.itervalues():
+            if len(members) < 2:
+                continue
+            members.sort(key=lambda member: (member[:2] in updated, member))
+            src = members[0]
+            src_updated = src[:2] in updated
+            for member in members[1:]:
+                if member[:2] == src[:2]:
+                    continue
+                if not src_updated and member[:2] not in updated:
+                    continue
+                matches[member[:2]].append((member[2], src))
+
+    ranges = {}
+    for dest, dest_matches in matches.iteritems():
+        dest_matches.sort()
+        merged = []
+        for dest_offset, (src_vol_id, src_ino, src_offset) in dest_matches:
+            if merged:
+                last = merged[-1]
+                if (
+                    (last.src_vol_id, last.src_ino) == (src_vol_id, src_ino)
+                    and last.dest_offset + last.length == dest_offset
+                    and last.src_offset + last.length == src_offset
+                ):
+                    merged[-1] = last._replace(
+                        length=last.length + BLOCK_SIZE)
+                    continue
+            merged.append(BlockRange(
+                dest_offset, src_vol_id, src_ino, src_offset, BLOCK_SIZE))
+        ranges[dest] = merged
+    return ranges
+
+
+def _physical_map(extents, offset, length):
+    # Where the data of a range is, relative to the start of the range;
+    # None if some of it isn't known yet.
+    end = offset + length
+    pieces = []
+    for extent in extents:
+        if extent.logical + extent.length <= offset:
+            continue
+        if extent.logical >= end:
+            break
+        if extent.flags & fiemap_lib.FIEMAP_EXTENT_UNKNOWN:
+            return
+        start = max(offset, extent.logical)
+        stop = min(end, extent.logical + extent.length)
+        pieces.append((
+            start - offset, extent.physical + start - extent.logical,
+            stop - start))
+    return pieces
+
+
+def ranges_share_extents(extents1, offset1, extents2, offset2, length):
+    """Whether two ranges are stored in the same place,
+    given the FIEMAP extents of their files."""
+
+    map1 = _physical_map(extents1, offset1, length)
+    return map1 is not None and map1 == _physical_map(
+        extents2, offset2, length)
+
+
+def dedup_pair(reader, sfd, dfd, ranges, use_extent_same, proc_index=None):
+    """Deduplicates the BlockRanges of dfd that match sfd.
+
+    Both files are locked once for all the ranges.
+    Yields (range, number of bytes shared) for the ranges that
+    were deduplicated.
+    """
+
+    sextents = list(fiemap(sfd))
+    dextents = list(fiemap(dfd))
+    ranges = [
+        rng for rng in ranges if not ranges_share_extents(
+            sextents, rng.src_offset, dextents, rng.dest_offset, rng.length)]
+    if not ranges:
+        return
+    if use_extent_same:
+        for rng in ranges:
+            # Errors only leave the range partly deduplicated
+            deduped, errors = extent_same(
+                sfd, [dfd], rng.length, rng.src_offset, [rng.dest_offset])
+            if deduped[dfd]:
+                yield rng, deduped[dfd]
+        return
+    # Don't wait for the throttle while holding the files locked
+    locked_reader = reader.locked()
+    with ImmutableFDs([sfd, dfd], proc_index) as immutability:
+        if immutability.fds_in_write_use:
+            return
+        for rng in ranges:
+            # Digests may be stale
+            if not locked_reader.cmp_ranges(
+                sfd, rng.src_offset, dfd, rng.dest_offset, rng.length
+            ):
+                continue
+            clone_range(
+                dfd, sfd, rng.src_offset, rng.length, rng.dest_offset)
+            yield rng, rng.length
+
+
+def _open_rw(sess, vol, ino, tt):
+    try:
+        pathb = lookup_ino_path_one(vol.fd, ino)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        # The inode was removed, don't match its blocks again
+        forget_block_digests(sess, vol.impl.id, ino)
+        sess.commit()
+        tt.notify('Inode %d of %s was removed, skipping' % (ino, vol))
+        return
+    try:
+        return fopenat_rw(vol.fd, pathb)
+    except IOError as e:
+        if e.errno in (errno.ENOENT, errno.ETXTBSY, errno.EACCES):
+            tt.notify('Can\'t open inode %d of %s, skipping' % (ino, vol))
+            return
+        raise
+
+
+def dedup_ranges(
+    sess, vols_by_id, fs, tt, reader, ranges, use_extent_same, proc_index
+):
+    space_gain = 0
+    tt.format(
+        '{elapsed} Block ranges of {bdest:counter}/{bdest:total} files '
+        'freed {space_gain:size} {read_rate}')
+    tt.set_total(bdest=len(ranges))
+    for (dvol_id, dino), dest_ranges in ranges.iteritems():
+        tt.update(bdest=None)
+        if reader.throttle is not None:
+            tt.update(read_rate=reader.throttle.describe())
+            reader.throttle.pause()
+        dvol = vols_by_id[dvol_id]
+        with ExitStack() as stack:
+            dfile = _open_rw(sess, dvol, dino, tt)
+            if dfile is None:
+                continue
+            stack.enter_context(closing(dfile))
+            by_src = defaultdict(list)
+            for rng in dest_ranges:
+                by_src[rng.src_vol_id, rng.src_ino].append(rng)
+            for src, src_ranges in sorted(by_src.iteritems()):
+                sfile = _open_rw(
+                    sess, vols_by_id[src[0]], src[1], tt)
+                if sfile is None:
+                    continue
+                with closing(sfile):
+                    deduped = list(dedup_pair(
+                        reader, sfile.fileno(), dfile.fileno(), src_ranges,
+                        use_extent_same, proc_index))
+                for rng, gained in deduped:
+                    tt.notify(
+                        'Deduplicated %d bytes:\n- inode %d of %s at %d\n'
+                        '- inode %d of %s at %d' % (
+                            gained, src[1], vols_by_id[src[0]],
+                            rng.src_offset, dino, dvol, rng.dest_offset))
+                    space_gain += gained
+                    tt.update(space_gain=space_gain)
+                    evt = DedupEvent(
+                        fs=fs.impl, item_size=gained, created=system_now())
+                    sess.add(evt)
+                    for vol_id, ino in (src, (dvol_id, dino)):
+                        sess.add(DedupEventInode(
+                            event=evt, ino=ino, vol=vols_by_id[vol_id].impl))
+                    sess.commit()
+    tt.format(None)
+    return space_gain
+
+
+def dedup_blocks(
+    sess, volset, tt, read_buffer_size=DEFAULT_READ_BUFFER_SIZE,
+    backend='clone', read_strategy=DEFAULT_READ_STRATEGY, throttle=None,
+    proc_scan_interval=0,
+):
+    fs = volset[0].fs
+    vols_by_id = dict((vol.impl.id, vol) for vol in volset)
+    use_extent_same = (
+        backend == 'extent-same' and has_extent_same(volset[0].fd))
+    # Chunks have to hold whole blocks
+    reader = Reader(max(
+        BLOCK_SIZE, read_buffer_size - read_buffer_size % BLOCK_SIZE),
+        read_strategy, throttle)
+
+    updated, digests = digest_blocks(sess, vols_by_id, tt, reader)
+    ranges = find_ranges(sess, vols_by_id.keys(), updated, digests)
+    if not ranges:
+        return
+    tt.notify(
+        'Matched blocks of %d files with %d ranges' % (
+            len(ranges), sum(len(li) for li in ranges.itervalues())))
+    space_gain = dedup_ranges(
+        sess, vols_by_id, fs, tt, reader, ranges, use_extent_same,
+        ProcFdIndex(proc_scan_interval))
+    tt.notify('Block-level deduplication freed %d bytes' % space_gain)
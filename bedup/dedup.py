@@ -20,17 +20,24 @@
 
 import collections
 import errno
-import glob
 import os
 import re
 import stat
 
+try:
+    # Python 3.5, or the scandir package
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 from .platform.btrfs import clone_data, defragment as btrfs_defragment
 from .platform.chattr import editflags, FS_IMMUTABLE_FL
 from .platform.futimens import fstat_ns, futimens
-
-
-BUFSIZE = 8192
+from .platform.time import monotonic_time
+from .reading import default_reader
 
 
 class FilesDifferError(ValueError):
@@ -63,23 +70,12 @@ def proc_use_info(proc_path):
             is_writable=bool(mode & stat.S_IWUSR))
 
 
-def cmp_fds(fd1, fd2):
-    # Python 3 can take closefd=False instead of a duplicated fd.
-    fi1 = os.fdopen(os.dup(fd1), 'rb')
-    fi2 = os.fdopen(os.dup(fd2), 'rb')
-    return cmp_files(fi1, fi2)
+def cmp_fds(fd1, fd2, reader=default_reader):
+    return reader.cmp_files(fd1, fd2)
 
 
-def cmp_files(fi1, fi2):
-    fi1.seek(0)
-    fi2.seek(0)
-    while True:
-        b1 = fi1.read(BUFSIZE)
-        b2 = fi2.read(BUFSIZE)
-        if b1 != b2:
-            return False
-        if not b1:
-            return True
+def cmp_files(fi1, fi2, reader=default_reader):
+    return reader.cmp_files(fi1.fileno(), fi2.fileno())
 
 
 def dedup_same(source, dests, defragment=False):
@@ -111,77 +107,129 @@ def dedup_same(source, dests, defragment=False):
 PROC_PATH_RE = re.compile(r'^/proc/(\d+)/fd/(\d+)$')
 
 
-def find_inodes_in_write_use(fds):
-    for (fd, use_info) in find_inodes_in_use(fds):
+def find_inodes_in_write_use(fds, proc_index=None):
+    for (fd, use_info) in find_inodes_in_use(fds, proc_index):
         if use_info.is_writable:
             yield (fd, use_info)
 
 
-def find_inodes_in_use(fds):
-    """
-    Find which of these inodes are in use, and give their open modes.
+def _list_dir(path):
+    # Processes come and go while we look
+    try:
+        if scandir is not None:
+            return [entry.name for entry in scandir(path)]
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return ()
+        raise
 
-    Does not count the passed fds as an use of the inode they point to,
-    but if the current process has the same inodes open with different
-    file descriptors these will be listed.
 
-    Looks at /proc/*/fd and /proc/*/map_files (Linux 3.3).
-    Conceivably there are other uses we're missing, to be foolproof
-    will require support in btrfs itself; a share-same-range ioctl
-    would work well.
+class ProcFdIndex(object):
+    """
+    An index of the inodes that processes have open or mapped.
+
+    Maps (st_dev, st_ino) to the /proc/*/fd and /proc/*/map_files
+    (Linux 3.3) entries that pointed to them during the last sweep
+    of /proc.  Sweeping stats every entry; with a refresh_interval,
+    sweeps are reused for that many seconds.  Entries returned by
+    find_uses are checked again, but files opened since the sweep
+    are missed, which is why the default is to sweep every time.
     """
 
-    self_pid = os.getpid()
-    id_fd_assoc = collections.defaultdict(list)
-
-    for fd in fds:
-        st = os.fstat(fd)
-        id_fd_assoc[(st.st_dev, st.st_ino)].append(fd)
-
-    def st_id_candidates(it):
-        for proc_path in it:
-            try:
-                st = os.stat(proc_path)
-            except OSError as e:
-                # glob opens directories during matching,
-                # and other processes might close their fds in the meantime.
-                # This isn't a problem for the immutable-locked use case.
-                if e.errno == errno.ENOENT:
-                    continue
-                raise
+    def __init__(self, refresh_interval=0):
+        self.refresh_interval = refresh_interval
+        self.sweeps = 0
+        self._index = None
+        self._swept_at = None
 
-            st_id = (st.st_dev, st.st_ino)
-            if st_id not in id_fd_assoc:
+    def sweep(self):
+        index = collections.defaultdict(list)
+        for pid in _list_dir('/proc'):
+            if not pid.isdigit():
                 continue
+            for kind in ('fd', 'map_files'):
+                dir_path = '/proc/%s/%s' % (pid, kind)
+                for name in _list_dir(dir_path):
+                    proc_path = dir_path + '/' + name
+                    try:
+                        st = os.stat(proc_path)
+                    except OSError as e:
+                        # Other processes might close their fds
+                        # in the meantime.
+                        # This isn't a problem for the immutable-locked
+                        # use case.
+                        if e.errno == errno.ENOENT:
+                            continue
+                        raise
+                    index[st.st_dev, st.st_ino].append(proc_path)
+        self._index = index
+        self._swept_at = monotonic_time()
+        self.sweeps += 1
+
+    def find_uses(self, fds):
+        """
+        Find which of these inodes are in use, and give their open modes.
+
+        See find_inodes_in_use.
+        """
+
+        if (
+            self._index is None
+            or monotonic_time() - self._swept_at >= self.refresh_interval
+        ):
+            self.sweep()
+
+        self_pid = os.getpid()
+        id_fd_assoc = collections.defaultdict(list)
+        for fd in fds:
+            st = os.fstat(fd)
+            id_fd_assoc[(st.st_dev, st.st_ino)].append(fd)
+
+        for st_id, original_fds in id_fd_assoc.iteritems():
+            for proc_path in self._index.get(st_id, ()):
+                # The entry may have been closed or reused since the sweep
+                try:
+                    st = os.stat(proc_path)
+                except OSError as e:
+                    if e.errno == errno.ENOENT:
+                        continue
+                    raise
+                if (st.st_dev, st.st_ino) != st_id:
+                    continue
 
-            yield proc_path, st_id
+                match = PROC_PATH_RE.match(proc_path)
+                if match:
+                    other_pid, other_fd = map(int, match.groups())
+                    if other_pid == self_pid and other_fd in original_fds:
+                        continue
 
-    for proc_path, st_id in st_id_candidates(glob.glob('/proc/[1-9]*/fd/*')):
-        other_pid, other_fd = map(
-            int, PROC_PATH_RE.match(proc_path).groups())
-        original_fds = id_fd_assoc[st_id]
-        if other_pid == self_pid:
-            if other_fd in original_fds:
-                continue
+                use_info = proc_use_info(proc_path)
+                if not use_info:
+                    continue
 
-        use_info = proc_use_info(proc_path)
-        if not use_info:
-            continue
+                for fd in original_fds:
+                    yield (fd, use_info)
 
-        for fd in original_fds:
-            yield (fd, use_info)
 
-    # Requires Linux 3.3
-    for proc_path, st_id in st_id_candidates(
-        glob.glob('/proc/[1-9]*/map_files/*')
-    ):
-        use_info = proc_use_info(proc_path)
-        if not use_info:
-            continue
+def find_inodes_in_use(fds, proc_index=None):
+    """
+    Find which of these inodes are in use, and give their open modes.
 
-        original_fds = id_fd_assoc[st_id]
-        for fd in original_fds:
-            yield (fd, use_info)
+    Does not count the passed fds as an use of the inode they point to,
+    but if the current process has the same inodes open with different
+    file descriptors these will be listed.
+
+    Looks at /proc/*/fd and /proc/*/map_files (Linux 3.3), through
+    proc_index (a ProcFdIndex) or a fresh sweep.
+    Conceivably there are other uses we're missing, to be foolproof
+    will require support in btrfs itself; a share-same-range ioctl
+    would work well.
+    """
+
+    if proc_index is None:
+        proc_index = ProcFdIndex()
+    return proc_index.find_uses(fds)
 
 
 RestoreInfo = collections.namedtuple(
@@ -205,8 +253,9 @@ class ImmutableFDs(object):
     # it is scoped to a mount namespace, which would complicate
     # attempts to enforce it with a remount.
 
-    def __init__(self, fds):
+    def __init__(self, fds, proc_index=None):
         self.__fds = fds
+        self.__proc_index = proc_index
         self.__revert_list = []
         self.__in_use = None
         self.__writable_fds = None
@@ -237,7 +286,9 @@ class ImmutableFDs(object):
         # We only track write use, other uses can appear after the /proc scan
         if self.__in_use is None:
             self.__in_use = collections.defaultdict(list)
-            for (fd, use_info) in find_inodes_in_write_use(self.__fds):
+            for (fd, use_info) in find_inodes_in_write_use(
+                self.__fds, self.__proc_index
+            ):
                 self.__in_use[fd].append(use_info)
             self.__writable_fds = frozenset(self.__in_use.keys())
 
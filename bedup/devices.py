@@ -0,0 +1,185 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Spreading reads over the devices of a multi-device filesystem."""
+
+import bisect
+
+from collections import defaultdict
+from multiprocessing.pool import ThreadPool
+
+from .platform.btrfs import read_chunk_tree, lib as btrfs_lib
+from .platform.fiemap import fiemap
+from .platform.ioprio import gettid, set_idle_priority
+
+
+STRIPED_PROFILES = (
+    btrfs_lib.BTRFS_BLOCK_GROUP_RAID0 | btrfs_lib.BTRFS_BLOCK_GROUP_RAID10
+    | btrfs_lib.BTRFS_BLOCK_GROUP_RAID5 | btrfs_lib.BTRFS_BLOCK_GROUP_RAID6)
+
+
+def stripe_index(chunk, offset):
+    """The stripe of chunk that holds offset (from the start of
+    the chunk); the first copy for mirrored profiles.
+
+    Follows the kernel's mapping of logical addresses for reads.
+    """
+
+    if not chunk.type & STRIPED_PROFILES or not chunk.stripe_len:
+        return 0
+    num_stripes = len(chunk.devids)
+    stripe_nr = offset // chunk.stripe_len
+    if chunk.type & btrfs_lib.BTRFS_BLOCK_GROUP_RAID0:
+        return stripe_nr % num_stripes
+    if chunk.type & btrfs_lib.BTRFS_BLOCK_GROUP_RAID10:
+        factor = num_stripes // chunk.sub_stripes
+        return stripe_nr % factor * chunk.sub_stripes
+    # Parity rotates by one stripe for every full stripe
+    if chunk.type & btrfs_lib.BTRFS_BLOCK_GROUP_RAID5:
+        data_stripes = num_stripes - 1
+    else:
+        data_stripes = num_stripes - 2
+    return (
+        stripe_nr // data_stripes + stripe_nr % data_stripes) % num_stripes
+
+
+class DeviceMap(object):
+    """Maps btrfs logical addresses (FIEMAP physical offsets)
+    to the devices that hold them, using the chunk tree.
+    """
+
+    def __init__(self, volume_fd):
+        self.chunks = read_chunk_tree(volume_fd)
+        self._starts = [chunk.logical for chunk in self.chunks]
+        self.devids = sorted(set(
+            devid for chunk in self.chunks for devid in chunk.devids))
+
+    def _chunk(self, logical):
+        i = bisect.bisect_right(self._starts, logical) - 1
+        if i < 0:
+            return
+        chunk = self.chunks[i]
+        if logical >= chunk.logical + chunk.length:
+            return
+        return chunk
+
+    def devid(self, logical):
+        """The device holding logical, or None."""
+
+        chunk = self._chunk(logical)
+        if chunk is None:
+            return
+        return chunk.devids[stripe_index(chunk, logical - chunk.logical)]
+
+    def device_ranges(self, logical, length):
+        """Yields (devid, length) for the pieces of a logical range,
+        split at chunk and stripe boundaries.
+        """
+
+        end = logical + length
+        while logical < end:
+            chunk = self._chunk(logical)
+            if chunk is None:
+                return
+            offset = logical - chunk.logical
+            piece_end = min(end, chunk.logical + chunk.length)
+            if chunk.type & STRIPED_PROFILES and chunk.stripe_len:
+                piece_end = min(piece_end, logical + (
+                    chunk.stripe_len - offset % chunk.stripe_len))
+            yield (
+                chunk.devids[stripe_index(chunk, offset)],
+                piece_end - logical)
+            logical = piece_end
+
+    def devid_of_file(self, fd):
+        """The device holding most of a file's data, or None."""
+
+        sizes = defaultdict(int)
+        for extent in fiemap(fd):
+            if not extent.physical:
+                continue
+            for devid, length in self.device_ranges(
+                extent.physical, extent.length
+            ):
+                sizes[devid] += length
+        if not sizes:
+            return
+        return max(sorted(sizes), key=sizes.__getitem__)
+
+
+def _device_worker_init():
+    set_idle_priority(gettid())
+
+
+class DeviceQueues(object):
+    """Keeps every device of the filesystem busy.
+
+    Files are queued on the device holding most of their data; reads
+    of a file whose data is spread over several devices (striped
+    profiles) aren't split between the queues.
+    """
+
+    def __init__(self, device_map):
+        self.device_map = device_map
+
+    def for_fds(self, fds):
+        """A FileQueues for a group of files, each of them
+        assigned to its device once."""
+
+        return FileQueues(dict(
+            (fd, self.device_map.devid_of_file(fd)) for fd in fds))
+
+
+class FileQueues(object):
+    """A map() over files whose devices are known.
+
+    Each device queue is served in order by a thread of its own,
+    at idle I/O priority; threads are started on first use and
+    kept until close.  Results come back in the order of the
+    arguments.
+    """
+
+    def __init__(self, devids):
+        self.devids = devids
+        self._pools = {}
+
+    def map(self, fn, fds):
+        fds = list(fds)
+        queues = defaultdict(list)
+        for i, fd in enumerate(fds):
+            queues[self.devids.get(fd)].append((i, fd))
+        if len(queues) < 2:
+            return map(fn, fds)
+        pending = []
+        for devid, items in queues.iteritems():
+            if devid not in self._pools:
+                self._pools[devid] = ThreadPool(
+                    1, initializer=_device_worker_init)
+            pending.append((items, self._pools[devid].apply_async(
+                map, (fn, [fd for i, fd in items]))))
+        results = [None] * len(fds)
+        for items, async_result in pending:
+            for (i, fd), result in zip(items, async_result.get()):
+                results[i] = result
+        return results
+
+    def close(self):
+        for pool in self._pools.itervalues():
+            pool.close()
+            pool.join()
+        self._pools.clear()
@@ -392,6 +392,9 @@ class WholeFS(object):
             self.sess, Volume, fs=fs._impl, root_id=root_id)
 
         if self._size_cutoff is not None:
+            if db_vol.size_cutoff != self._size_cutoff:
+                # An interrupted scan used the old cutoff
+                db_vol.clear_scan_cursor()
             db_vol.size_cutoff = self._size_cutoff
         elif db_vol_created:
             db_vol.size_cutoff = DEFAULT_SIZE_CUTOFF
@@ -16,21 +16,253 @@
 # You should have received a copy of the GNU General Public License
 # along with bedup.  If not, see <http://www.gnu.org/licenses/>.
 
-from zlib import adler32
+import errno
+import hashlib
+import os
+import struct
+from zlib import adler32, crc32
 
-from .platform.fiemap import fiemap
+from .platform.btrfs import (
+    extent_csums, file_extents, lib as btrfs_lib, TreeSearch,
+    EXTENT_SEARCH_BUF_SIZE)
+from .platform.fiemap import fiemap, lib as fiemap_lib
+from .reading import SEEK_DATA
 
 
-def mini_hash_from_file(inode, rfile):
-    # A very cheap, very partial hash for quick disambiguation
-    # Won't help with things like zeroed or sparse files.
-    # The mini_hash for those is 0x10000001
-    rfile.seek(int(inode.size * .3))
-    # bitops to make unsigned, for better readability
-    return adler32(rfile.read(4096)) & 0xffffffff
+# These hashes are stored in the database.
+# The version is kept in the high bits; bump it whenever the encoding
+# changes and stored hashes of other versions will be recomputed.
+MINI_HASH_VERSION = 2
+FIEMAP_HASH_VERSION = 2
+# Extent hashes made from the subvolume tree rather than FIEMAP.
+# Both kinds are valid fiemap_hash values, but they never match
+# each other; the 0x40 bit keeps their versions apart.
+EXTENT_TREE_HASH_VERSION = 0x40 | 1
+
+DEFAULT_INTERIOR_SAMPLES = 3
+SAMPLE_SIZE = 4096
+
+# How the samples of a file looked
+SAMPLE_DATA = 0
+# Only zeroes and holes; the rest of the file may be zeroes as well
+SAMPLE_ZERO = 1
+# The whole file is a hole
+SAMPLE_HOLE = 2
+
+
+def _read_sample(fd, offset, length, throttle=None):
+    # Returns None when the sample is inside a hole
+    try:
+        data_start = os.lseek(fd, offset, SEEK_DATA)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            return
+        if e.errno != errno.EINVAL:
+            raise
+        # No SEEK_DATA support
+        data_start = offset
+    if data_start >= offset + length:
+        return
+    if throttle is not None:
+        throttle.pause()
+        throttle.wait()
+    os.lseek(fd, offset, os.SEEK_SET)
+    buf = os.read(fd, length)
+    if throttle is not None:
+        throttle.charge(len(buf))
+    return buf
+
+
+def _has_data(fd):
+    try:
+        os.lseek(fd, 0, SEEK_DATA)
+    except OSError as e:
+        if e.errno == errno.ENXIO:
+            return False
+        if e.errno != errno.EINVAL:
+            raise
+    return True
+
+
+class MiniHashSampler(object):
+    """A very cheap, very partial hash for quick disambiguation.
+
+    Hashes the head and tail of the file, plus some evenly spaced blocks
+    in between.  Holes are hashed as zeroes without being read, and
+    files whose samples are all zero are classified so that they can
+    be handled separately.
+    Reads go through throttle, a ReadThrottle, if given.
+    """
+
+    def __init__(
+        self, interior=DEFAULT_INTERIOR_SAMPLES, sample_size=SAMPLE_SIZE,
+        throttle=None,
+    ):
+        self.interior = interior
+        self.sample_size = sample_size
+        self.throttle = throttle
+        # Hashes from different settings can't be compared
+        self.tag = crc32(
+            ('%d %d' % (interior, sample_size)).encode('ascii')) & 0xffff
+
+    def offsets(self, size):
+        last = max(0, size - self.sample_size)
+        offsets = [0]
+        for i in xrange(1, self.interior + 1):
+            offset = last * i // (self.interior + 1)
+            offsets.append(offset - offset % self.sample_size)
+        offsets.append(last)
+        return offsets
+
+    def sample(self, fd, size):
+        """Returns the mini hash and sample class of a file."""
+
+        checksum = adler32(b'')
+        all_zero = True
+        for offset in self.offsets(size):
+            length = min(self.sample_size, size - offset)
+            buf = _read_sample(fd, offset, length, self.throttle)
+            if buf is None:
+                buf = b'\0' * length
+            elif buf.strip(b'\0'):
+                all_zero = False
+            checksum = adler32(buf, checksum)
+
+        if not all_zero:
+            sample_class = SAMPLE_DATA
+        elif _has_data(fd):
+            sample_class = SAMPLE_ZERO
+        else:
+            sample_class = SAMPLE_HOLE
+        # bitops to make unsigned, for better readability
+        return (
+            (MINI_HASH_VERSION << 48) | (self.tag << 32)
+            | (checksum & 0xffffffff)), sample_class
+
+    def current_range(self):
+        """The lowest and highest mini hashes of these settings,
+        so that queries can tell which stored hashes are current."""
+
+        low = ((MINI_HASH_VERSION << 16) | self.tag) << 32
+        return low, low | 0xffffffff
+
+    def is_current(self, mini_hash):
+        low, high = self.current_range()
+        return mini_hash is not None and low <= mini_hash <= high
+
+
+default_sampler = MiniHashSampler()
 
 
 def fiemap_hash_from_file(rfile):
-    extents = tuple(fiemap(rfile.fileno()))
-    return hash(extents)
+    """Hashes the extent map of a file.
+
+    Files with the same hash share all their data.  Returns None if some
+    of the data has no location of its own yet (delayed allocation,
+    inline extents), since those would all look alike.
+    """
+
+    # The shared flag changes when other files get deduplicated
+    flags_mask = ~fiemap_lib.FIEMAP_EXTENT_SHARED
+    unplaced = (
+        fiemap_lib.FIEMAP_EXTENT_UNKNOWN | fiemap_lib.FIEMAP_EXTENT_DELALLOC
+        | fiemap_lib.FIEMAP_EXTENT_DATA_INLINE)
+    hasher = hashlib.sha1()
+    for extent in fiemap(rfile.fileno()):
+        if extent.flags & unplaced:
+            return
+        hasher.update(struct.pack(
+            '<QQQI', extent.logical, extent.physical, extent.length,
+            extent.flags & flags_mask))
+    # 56 bits of digest, so that the result fits a signed SQLite integer
+    return (FIEMAP_HASH_VERSION << 56) | int(hasher.hexdigest()[:14], 16)
+
+
+def extent_tree_hash(extents):
+    """Hashes the FileExtents of a file, as found by a tree search.
+
+    Returns None if the file has inline extents.
+    """
+
+    hasher = hashlib.sha1()
+    for extent in extents:
+        if extent.type == btrfs_lib.BTRFS_FILE_EXTENT_INLINE:
+            return
+        if extent.disk_bytenr == 0:
+            # A hole
+            continue
+        hasher.update(struct.pack(
+            '<QQQQQBB', extent.logical, extent.disk_bytenr,
+            extent.disk_num_bytes, extent.offset, extent.num_bytes,
+            extent.type, extent.compression))
+    return (
+        (EXTENT_TREE_HASH_VERSION << 56) | int(hasher.hexdigest()[:14], 16))
+
+
+class CsumFingerprinter(object):
+    """Fingerprints files with the data checksums btrfs keeps.
+
+    Files with the same contents get the same fingerprint if their data
+    is uncompressed and checksummed; nothing is read but metadata.
+    Zeroes that are holes or preallocated and zeroes that were written
+    don't match.  Not thread-safe, the searches keep their buffers.
+    """
+
+    def __init__(self, fd):
+        self.sectorsize = os.fstatvfs(fd).f_bsize
+        self.csum_search = TreeSearch(
+            fd, tree_id=btrfs_lib.BTRFS_CSUM_TREE_OBJECTID,
+            buf_size=EXTENT_SEARCH_BUF_SIZE)
+        # One per volume, tree_id=0 searches the volume of the fd
+        self._extent_searches = {}
+
+    def fingerprint(self, volume_fd, ino, size):
+        """Returns a digest string, or None if the file has extents
+        without usable checksums."""
+
+        if volume_fd not in self._extent_searches:
+            self._extent_searches[volume_fd] = TreeSearch(
+                volume_fd, tree_id=0, buf_size=EXTENT_SEARCH_BUF_SIZE)
+        sectorsize = self.sectorsize
+        end = size + -size % sectorsize
+        hasher = hashlib.sha1()
+        # Extent boundaries must not matter, only sectors do.
+        # Runs of zeroes without checksums are hashed as their length.
+        pos = zero_run = 0
+        for extent in file_extents(self._extent_searches[volume_fd], ino):
+            if extent.logical >= end:
+                break
+            if extent.type == btrfs_lib.BTRFS_FILE_EXTENT_INLINE:
+                return
+            # Implicit hole (no-holes feature)
+            zero_run += extent.logical - pos
+            pos = min(end, extent.logical + extent.num_bytes)
+            length = pos - extent.logical
+            if (
+                extent.disk_bytenr == 0
+                or extent.type == btrfs_lib.BTRFS_FILE_EXTENT_PREALLOC
+            ):
+                zero_run += length
+                continue
+            if extent.compression:
+                # The checksums are those of the compressed data
+                return
+            csums = extent_csums(
+                self.csum_search, extent.disk_bytenr + extent.offset,
+                length, sectorsize)
+            if csums is None:
+                return
+            if zero_run:
+                hasher.update(struct.pack('<cQ', b'Z', zero_run))
+                zero_run = 0
+            hasher.update(csums)
+        zero_run += end - pos
+        if zero_run:
+            hasher.update(struct.pack('<cQ', b'Z', zero_run))
+        return 'csum-' + hasher.hexdigest()
+
+
+def fiemap_hash_is_current(fiemap_hash):
+    return fiemap_hash is not None and fiemap_hash >> 56 in (
+        FIEMAP_HASH_VERSION, EXTENT_TREE_HASH_VERSION)
 
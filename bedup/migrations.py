@@ -21,17 +21,60 @@
 from alembic.migration import MigrationContext
 from alembic.operations import Operations
 from sqlalchemy import MetaData
+from sqlalchemy.schema import Column, ForeignKey
+from sqlalchemy.types import Integer, Text
 
 from .model import META
 
 
-REV = 1
+REV = 7
 
 
 def upgrade_with_range(context, from_rev, to_rev):
-    assert from_rev == to_rev
+    assert from_rev <= to_rev
     op = Operations(context)
-    #from IPython import embed; embed()
+
+    if from_rev < 2:
+        # Resumable scans
+        for name in (
+            'scan_top_generation', 'scan_min_objectid', 'scan_min_type',
+            'scan_min_offset',
+        ):
+            op.add_column('Volume', Column(name, Integer, nullable=True))
+
+    if from_rev < 3:
+        # Inode identity and modification tracking
+        for name in ('generation', 'transid'):
+            op.add_column('Inode', Column(name, Integer, nullable=True))
+
+    if from_rev < 4:
+        # Content digest cache
+        op.add_column('Inode', Column('digest', Text, nullable=True))
+        op.add_column(
+            'Inode', Column('digest_ctime', Integer, nullable=True))
+
+    if from_rev < 5:
+        # Mini hash sampling
+        op.add_column('Inode', Column('sample_class', Integer, nullable=True))
+
+    if from_rev < 6:
+        # Block-level dedup
+        op.add_column(
+            'Inode', Column('block_transid', Integer, nullable=True))
+        op.create_table(
+            'BlockDigest',
+            Column(
+                'vol_id', Integer, ForeignKey('Volume.id'),
+                primary_key=True, nullable=False),
+            Column('ino', Integer, primary_key=True),
+            Column('offset', Integer, primary_key=True),
+            Column('digest', Integer, nullable=False))
+        op.create_index(
+            'ix_BlockDigest_digest', 'BlockDigest', ['digest'])
+
+    if from_rev < 7:
+        # Telling apart metadata-only changes
+        op.add_column('Inode', Column('mtime', Integer, nullable=True))
 
 
 def upgrade_schema(engine, database_exists):
@@ -27,7 +27,9 @@ from sqlalchemy.schema import (
     Column, ForeignKey, UniqueConstraint, CheckConstraint)
 
 from .datetime import UTC
-from .hashing import mini_hash_from_file, fiemap_hash_from_file
+from .hashing import (
+    default_sampler, fiemap_hash_from_file, fiemap_hash_is_current)
+from .platform.chattr import getversion
 
 
 def parent_entity(cattr):
@@ -110,6 +112,31 @@ class Volume(Base):
     last_tracked_size_cutoff = Column(Integer, nullable=True)
     size_cutoff = Column(Integer, nullable=False)
 
+    # Where an interrupted scan will resume.
+    # The generation it was scanning up to, and the tree search key
+    # it had reached; everything before that key has been tracked.
+    scan_top_generation = Column(Integer, nullable=True)
+    scan_min_objectid = Column(Integer, nullable=True)
+    scan_min_type = Column(Integer, nullable=True)
+    scan_min_offset = Column(Integer, nullable=True)
+
+    @property
+    def scan_cursor(self):
+        if self.scan_top_generation is None:
+            return
+        return (
+            self.scan_min_objectid, self.scan_min_type, self.scan_min_offset)
+
+    def save_scan_cursor(self, top_generation, key):
+        self.scan_top_generation = top_generation
+        (self.scan_min_objectid, self.scan_min_type,
+         self.scan_min_offset) = key
+
+    def clear_scan_cursor(self):
+        self.scan_top_generation = None
+        self.scan_min_objectid = self.scan_min_type = None
+        self.scan_min_offset = None
+
 
 class VolumePathHistory(Base):
     id = Column(Integer, primary_key=True)
@@ -142,12 +169,40 @@ class InodeProps(object):
             select([Volume.fs_id]).where(
                 Volume.id == cls.vol_id).label('fs_id'), deferred=True)
 
-    def mini_hash_from_file(self, rfile):
-        self.mini_hash = mini_hash_from_file(self, rfile)
+    def mini_hash_from_file(self, rfile, sampler=default_sampler):
+        self.mini_hash, self.sample_class = sampler.sample(
+            rfile.fileno(), self.size)
 
     def fiemap_hash_from_file(self, rfile):
         self.fiemap_hash = fiemap_hash_from_file(rfile)
 
+    # Stored hashes are cleared when a scan sees the inode was modified
+    def has_mini_hash(self, sampler=default_sampler):
+        return sampler.is_current(self.mini_hash)
+
+    @property
+    def has_fiemap_hash(self):
+        return fiemap_hash_is_current(self.fiemap_hash)
+
+    def has_fresh_digest(self, ctime):
+        # The inode wasn't modified since we last checked the digest;
+        # ctime is the live value, which only the kernel sets.
+        return (
+            self.digest is not None and self.digest_ctime is not None
+            and self.digest_ctime == ctime)
+
+    def set_digest(self, digest):
+        # Fresh once stamped with the ctime that follows our own changes
+        self.digest = digest
+        self.digest_ctime = None
+
+    def is_reused_by(self, rfile):
+        """Whether rfile is a newer inode that reused our inode number."""
+
+        if self.generation is None:
+            return False
+        return getversion(rfile.fileno()) != self.generation & 0xffffffff
+
 
 class Inode(Base, InodeProps):
     vol_id, vol = FK(
@@ -159,9 +214,30 @@ class Inode(Base, InodeProps):
     # and it's the first criterion we'll use, so not nullable
     size = Column(Integer, index=True, nullable=False)
     mini_hash = Column(Integer, index=True, nullable=True)
+    # Whether the mini hash samples were data, zeroes or holes;
+    # see MiniHashSampler.
+    sample_class = Column(Integer, nullable=True)
     # A digest of that file's FIEMAP extent info.
     fiemap_hash = Column(Integer, index=True, nullable=True)
 
+    # From the inode item, as of the last scan that saw it.
+    # The generation the inode was created in tells apart inodes
+    # that reuse the same number; transid changes whenever
+    # the inode is modified, mtime (in nanoseconds) only when
+    # its data is.
+    # These are null for inodes tracked by older versions.
+    generation = Column(Integer, nullable=True)
+    transid = Column(Integer, nullable=True)
+    mtime = Column(Integer, nullable=True)
+
+    # Hex SHA1 of the whole file, and the ctime (in nanoseconds)
+    # it is valid for.
+    digest = Column(Text, nullable=True)
+    digest_ctime = Column(Integer, nullable=True)
+
+    # The transid the BlockDigest rows of this inode are valid for.
+    block_transid = Column(Integer, nullable=True)
+
     # has_updates gets set whenever this inode
     # appears in the volume scan, and reset whenever we do
     # a dedup pass.
@@ -171,6 +247,21 @@ class Inode(Base, InodeProps):
         return 'Inode(ino=%d, volume=%d)' % (self.ino, self.vol_id)
 
 
+# Digests of the data blocks of tracked files, for block-level dedup.
+# Like the logging classes, this doesn't reference Inode; rows are
+# removed along with their Inode (tracking.forget_inode), and stale
+# data is detected when the blocks are compared.
+class BlockDigest(Base):
+    vol_id, vol = FK(
+        Volume.id, primary_key=True, backref='block_digests',
+        cascade='all, delete-orphan')
+    ino = Column(Integer, primary_key=True)
+    # In bytes, a multiple of the block size
+    offset = Column(Integer, primary_key=True)
+    # A truncated SHA1, see bedup.blocks
+    digest = Column(Integer, index=True, nullable=False)
+
+
 Volume.inode_count = column_property(
     select([func.count(Inode.ino)])
         .where(Inode.vol_id == Volume.id)
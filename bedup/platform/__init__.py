@@ -19,9 +19,12 @@
 # along with bedup.  If not, see <http://www.gnu.org/licenses/>.
 
 from . import (
-    btrfs, chattr, fiemap, futimens, ioprio, openat, syncfs, time, unshare)
+    btrfs, chattr, fiemap, futimens, ioprio, openat, pread, syncfs, time,
+    unshare)
 
-MODS = (btrfs, chattr, fiemap, futimens, ioprio, openat, syncfs, time, unshare)
+MODS = (
+    btrfs, chattr, fiemap, futimens, ioprio, openat, pread, syncfs, time,
+    unshare)
 
 def get_ext_modules():
     return [mod.ffi.verifier.get_extension() for mod in MODS]
@@ -19,12 +19,15 @@
 # along with bedup.  If not, see <http://www.gnu.org/licenses/>.
 
 import cffi
+import errno
+import os
 import posixpath
 import uuid
 
 from ..compat import buffer_to_bytes
 
 from .fiemap import same_extents
+from .time import monotonic_time
 
 from os import getcwd  # XXX
 from collections import namedtuple
@@ -36,10 +39,14 @@ ffi.cdef("""
 /* ioctl.h */
 
 #define BTRFS_IOC_TREE_SEARCH ...
+#define BTRFS_IOC_TREE_SEARCH_V2 ...
 #define BTRFS_IOC_INO_PATHS ...
 #define BTRFS_IOC_INO_LOOKUP ...
 #define BTRFS_IOC_FS_INFO ...
 #define BTRFS_IOC_CLONE ...
+#define BTRFS_IOC_CLONE_RANGE ...
+#define BTRFS_IOC_FILE_EXTENT_SAME ...
+#define BTRFS_SAME_DATA_DIFFERS ...
 #define BTRFS_IOC_DEFRAG ...
 #define BTRFS_IOC_SUBVOL_GETFLAGS ...
 #define BTRFS_IOC_SUBVOL_SETFLAGS ...
@@ -92,6 +99,43 @@ struct btrfs_ioctl_search_args {
     char buf[];
 };
 
+struct btrfs_ioctl_search_args_v2 {
+    struct btrfs_ioctl_search_key key; /* in/out - search parameters */
+    uint64_t buf_size;                 /* in - size of buffer
+                                        * out - on EOVERFLOW: needed size
+                                        *       to store item */
+    uint64_t buf[];                    /* out - found items */
+};
+
+struct btrfs_ioctl_clone_range_args {
+    int64_t src_fd;
+    uint64_t src_offset, src_length;
+    uint64_t dest_offset;
+};
+
+struct btrfs_ioctl_same_extent_info {
+    int64_t fd;             /* in - destination file */
+    uint64_t logical_offset;        /* in - start of extent in destination */
+    uint64_t bytes_deduped; /* out - total # of bytes we
+                             * were able to dedupe from
+                             * this file */
+    /* status of this dedupe operation:
+     * 0 if dedup succeeds
+     * < 0 for error
+     * == BTRFS_SAME_DATA_DIFFERS if data differs
+     */
+    int32_t status;         /* out - see above description */
+    ...;
+};
+
+struct btrfs_ioctl_same_args {
+    uint64_t logical_offset;        /* in - start of extent in source */
+    uint64_t length;                /* in - length of extent */
+    uint16_t dest_count;            /* in - total elements in info array */
+    struct btrfs_ioctl_same_extent_info info[];
+    ...;
+};
+
 struct btrfs_data_container {
     uint32_t    bytes_left; /* out -- bytes not needed to deliver output */
     uint32_t    bytes_missing;  /* out -- additional bytes needed for result */
@@ -136,16 +180,33 @@ struct btrfs_ioctl_ino_lookup_args {
 #define BTRFS_DIR_INDEX_KEY ...
 #define BTRFS_ROOT_ITEM_KEY ...
 #define BTRFS_ROOT_BACKREF_KEY ...
+#define BTRFS_EXTENT_CSUM_KEY ...
+#define BTRFS_CHUNK_ITEM_KEY ...
+
+#define BTRFS_FILE_EXTENT_INLINE ...
+#define BTRFS_FILE_EXTENT_REG ...
+#define BTRFS_FILE_EXTENT_PREALLOC ...
 
 #define BTRFS_FIRST_FREE_OBJECTID ...
 #define BTRFS_ROOT_TREE_OBJECTID ...
 #define BTRFS_FS_TREE_OBJECTID ...
+#define BTRFS_CSUM_TREE_OBJECTID ...
+#define BTRFS_CHUNK_TREE_OBJECTID ...
+#define BTRFS_FIRST_CHUNK_TREE_OBJECTID ...
+#define BTRFS_EXTENT_CSUM_OBJECTID ...
 
 // A root_item flag
 // Not to be confused with a similar ioctl flag with a different value
 // XXX The kernel uses cpu_to_le64 to check this flag
 #define BTRFS_ROOT_SUBVOL_RDONLY ...
 
+#define BTRFS_BLOCK_GROUP_DATA ...
+#define BTRFS_BLOCK_GROUP_RAID0 ...
+#define BTRFS_BLOCK_GROUP_RAID1 ...
+#define BTRFS_BLOCK_GROUP_RAID10 ...
+#define BTRFS_BLOCK_GROUP_RAID5 ...
+#define BTRFS_BLOCK_GROUP_RAID6 ...
+
 
 struct btrfs_file_extent_item {
     /*
@@ -227,6 +288,19 @@ struct btrfs_inode_item {
     ...; // reserved/padding
 };
 
+struct btrfs_stripe {
+    uint64_t devid;
+    ...;
+};
+
+struct btrfs_chunk {
+    /* size of this chunk in bytes */
+    uint64_t length;
+    ...;
+    struct btrfs_stripe stripe;
+    /* additional stripes go here */
+};
+
 struct btrfs_root_item {
 // XXX CFFI and endianness: ???
     struct btrfs_inode_item inode;
@@ -309,7 +383,23 @@ struct btrfs_dir_item {
 };
 
 uint64_t btrfs_stack_file_extent_generation(struct btrfs_file_extent_item *s);
+uint8_t btrfs_stack_file_extent_type(struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_chunk_length(struct btrfs_chunk *s);
+uint16_t btrfs_stack_chunk_num_stripes(struct btrfs_chunk *s);
+uint64_t btrfs_stack_chunk_type(struct btrfs_chunk *s);
+uint64_t btrfs_stack_chunk_stripe_len(struct btrfs_chunk *s);
+uint16_t btrfs_stack_chunk_sub_stripes(struct btrfs_chunk *s);
+uint64_t btrfs_stack_stripe_devid(struct btrfs_stripe *s);
+uint8_t btrfs_stack_file_extent_compression(
+    struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_disk_bytenr(
+    struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_disk_num_bytes(
+    struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_offset(struct btrfs_file_extent_item *s);
+uint64_t btrfs_stack_file_extent_num_bytes(struct btrfs_file_extent_item *s);
 uint64_t btrfs_stack_inode_generation(struct btrfs_inode_item *s);
+uint64_t btrfs_stack_inode_transid(struct btrfs_inode_item *s);
 uint64_t btrfs_stack_inode_size(struct btrfs_inode_item *s);
 uint32_t btrfs_stack_inode_mode(struct btrfs_inode_item *s);
 uint64_t btrfs_stack_inode_ref_name_len(struct btrfs_inode_ref *s);
@@ -317,6 +407,23 @@ uint16_t btrfs_stack_root_ref_name_len(struct btrfs_root_ref *s);
 uint64_t btrfs_stack_root_ref_dirid(struct btrfs_root_ref *s);
 uint16_t btrfs_stack_dir_name_len(struct btrfs_dir_item *s);
 uint64_t btrfs_root_generation(struct btrfs_root_item *s);
+
+/* Helpers for decoding whole search buffers at once */
+
+uint32_t bedup_decode_search_buf(
+    char *buf, uint64_t buf_size, uint32_t nr_items,
+    uint64_t *objectid, uint32_t *type, uint64_t *offset, uint64_t *transid,
+    uint64_t *data_off, uint32_t *len,
+    uint64_t *inode_generation, uint64_t *inode_transid,
+    uint64_t *inode_size, uint32_t *inode_mode, uint64_t *inode_flags,
+    uint64_t *inode_mtime);
+
+uint32_t bedup_select_files(
+    uint32_t nr_items, uint32_t *type,
+    uint64_t *inode_transid, uint64_t *inode_size, uint32_t *inode_mode,
+    uint64_t size_cutoff, uint64_t min_generation,
+    uint64_t old_size_cutoff, uint64_t old_min_generation,
+    uint32_t *selected, uint32_t *nr_inode_items);
 """)
 
 
@@ -324,6 +431,124 @@ uint64_t btrfs_root_generation(struct btrfs_root_item *s);
 lib = ffi.verify('''
     #include <btrfs-progs/ioctl.h>
     #include <btrfs-progs/ctree.h>
+
+    #ifndef BTRFS_IOC_TREE_SEARCH_V2
+    /* Linux 3.16; older btrfs-progs headers don't have it */
+    struct btrfs_ioctl_search_args_v2 {
+        struct btrfs_ioctl_search_key key;
+        __u64 buf_size;
+        __u64 buf[0];
+    };
+    #define BTRFS_IOC_TREE_SEARCH_V2 _IOWR(BTRFS_IOCTL_MAGIC, 17, \\
+                                       struct btrfs_ioctl_search_args_v2)
+    #endif
+
+    #ifndef BTRFS_IOC_FILE_EXTENT_SAME
+    /* Linux 3.12 */
+    struct btrfs_ioctl_same_extent_info {
+        __s64 fd;
+        __u64 logical_offset;
+        __u64 bytes_deduped;
+        __s32 status;
+        __u32 reserved;
+    };
+    struct btrfs_ioctl_same_args {
+        __u64 logical_offset;
+        __u64 length;
+        __u16 dest_count;
+        __u16 reserved1;
+        __u32 reserved2;
+        struct btrfs_ioctl_same_extent_info info[0];
+    };
+    #define BTRFS_SAME_DATA_DIFFERS 1
+    #define BTRFS_IOC_FILE_EXTENT_SAME _IOWR(BTRFS_IOCTL_MAGIC, 54, \
+                                         struct btrfs_ioctl_same_args)
+    #endif
+
+    #include <sys/stat.h>
+
+    static uint32_t bedup_decode_search_buf(
+        char *buf, uint64_t buf_size, uint32_t nr_items,
+        uint64_t *objectid, uint32_t *type, uint64_t *offset,
+        uint64_t *transid, uint64_t *data_off, uint32_t *len,
+        uint64_t *inode_generation, uint64_t *inode_transid,
+        uint64_t *inode_size, uint32_t *inode_mode, uint64_t *inode_flags,
+        uint64_t *inode_mtime)
+    {
+        uint64_t pos = 0;
+        uint32_t i;
+
+        for (i = 0; i < nr_items; ++i) {
+            struct btrfs_ioctl_search_header *sh;
+            struct btrfs_inode_item *item;
+
+            if (pos + sizeof(*sh) > buf_size)
+                break;
+            sh = (struct btrfs_ioctl_search_header *)(buf + pos);
+            pos += sizeof(*sh);
+            if (pos + sh->len > buf_size)
+                break;
+
+            objectid[i] = sh->objectid;
+            type[i] = sh->type;
+            offset[i] = sh->offset;
+            transid[i] = sh->transid;
+            data_off[i] = pos;
+            len[i] = sh->len;
+            if (sh->type == BTRFS_INODE_ITEM_KEY
+                && sh->len >= sizeof(*item)) {
+                item = (struct btrfs_inode_item *)(sh + 1);
+                inode_generation[i] = btrfs_stack_inode_generation(item);
+                inode_transid[i] = btrfs_stack_inode_transid(item);
+                inode_size[i] = btrfs_stack_inode_size(item);
+                inode_mode[i] = btrfs_stack_inode_mode(item);
+                inode_flags[i] = btrfs_stack_inode_flags(item);
+                /* In nanoseconds */
+                inode_mtime[i] =
+                    btrfs_stack_timespec_sec(&item->mtime) * 1000000000ULL
+                    + btrfs_stack_timespec_nsec(&item->mtime);
+            } else {
+                inode_generation[i] = inode_transid[i] = inode_size[i] = 0;
+                inode_mode[i] = 0;
+                inode_flags[i] = inode_mtime[i] = 0;
+            }
+            pos += sh->len;
+        }
+        return i;
+    }
+
+    /* Regular files with size >= size_cutoff, modified (transid) since
+     * min_generation, or old_min_generation if the size is
+     * above a non-zero old_size_cutoff. */
+    static uint32_t bedup_select_files(
+        uint32_t nr_items, uint32_t *type,
+        uint64_t *inode_transid, uint64_t *inode_size,
+        uint32_t *inode_mode,
+        uint64_t size_cutoff, uint64_t min_generation,
+        uint64_t old_size_cutoff, uint64_t old_min_generation,
+        uint32_t *selected, uint32_t *nr_inode_items)
+    {
+        uint32_t i, nr_selected = 0, nr_inodes = 0;
+
+        for (i = 0; i < nr_items; ++i) {
+            if (type[i] != BTRFS_INODE_ITEM_KEY)
+                continue;
+            ++nr_inodes;
+            if (inode_size[i] < size_cutoff)
+                continue;
+            if (old_size_cutoff && inode_size[i] >= old_size_cutoff) {
+                if (inode_transid[i] < old_min_generation)
+                    continue;
+            } else if (inode_transid[i] < min_generation) {
+                continue;
+            }
+            if (!S_ISREG(inode_mode[i]))
+                continue;
+            selected[nr_selected++] = i;
+        }
+        *nr_inode_items = nr_inodes;
+        return nr_selected;
+    }
     ''',
     ext_package='bedup',
     include_dirs=[getcwd()])
@@ -332,9 +557,42 @@ lib = ffi.verify('''
 BTRFS_FIRST_FREE_OBJECTID = lib.BTRFS_FIRST_FREE_OBJECTID
 
 u64_max = ffi.cast('uint64_t', -1)
+U64_MAX = 2 ** 64 - 1
+U32_MAX = 2 ** 32 - 1
+U8_MAX = 2 ** 8 - 1
+
+# The kernel won't fill more than this with a single v2 search.
+TREE_SEARCH_MAX_BUF_SIZE = 16 * 1024 ** 2
+DEFAULT_TREE_SEARCH_BUF_SIZE = 1024 ** 2
+
+# None until a search tells us whether the kernel has the v2 ioctl
+_has_tree_search_v2 = None
 
 RootInfo = namedtuple('RootInfo', 'path parent_root_id is_frozen')
 
+# A chunk of the logical address space, and the devices holding it
+# (one per stripe, so mirrored devices and striped devices alike).
+# type has the BTRFS_BLOCK_GROUP_* profile flags; stripe_len and
+# sub_stripes say how the data is spread over the stripes.
+Chunk = namedtuple(
+    'Chunk', 'logical length devids type stripe_len sub_stripes')
+
+# An EXTENT_DATA item; logical is the file offset from the item key.
+# Only logical, type and compression are set for inline extents.
+FileExtent = namedtuple(
+    'FileExtent',
+    'logical type disk_bytenr disk_num_bytes offset num_bytes compression')
+
+# Enough for the extent items of most files in one search
+EXTENT_SEARCH_BUF_SIZE = 64 * 1024
+
+# crc32c.  The other checksum types (Linux 5.5) aren't detected;
+# their checksums get sliced wrong, which only makes for fingerprints
+# that don't match.
+CSUM_SIZE = 4
+# No leaf is larger; bounds the range covered by a single csum item.
+MAX_NODESIZE = 64 * 1024
+
 
 def name_of_inode_ref(ref):
     namelen = lib.btrfs_stack_inode_ref_name_len(ref)
@@ -368,6 +626,385 @@ def ioctl_pybug(fd, ioc, arg=0):
     return fcntl.ioctl(fd, ioc, arg, True)
 
 
+class SearchBatch(object):
+    """Columns decoded from a search buffer, one array element per item.
+
+    The inode_ columns are zero for items that aren't inode items.
+    Arrays are reused from one buffer to the next.
+    """
+
+    COLUMNS = (
+        ('objectid', 'uint64_t'),
+        ('type', 'uint32_t'),
+        ('offset', 'uint64_t'),
+        ('transid', 'uint64_t'),
+        ('data_off', 'uint64_t'),
+        ('len', 'uint32_t'),
+        ('inode_generation', 'uint64_t'),
+        ('inode_transid', 'uint64_t'),
+        ('inode_size', 'uint64_t'),
+        ('inode_mode', 'uint32_t'),
+        ('inode_flags', 'uint64_t'),
+        ('inode_mtime', 'uint64_t'),
+    )
+
+    def __init__(self):
+        self.capacity = 0
+        self.nr_items = 0
+        self._buf = None
+        self._selected = None
+        self._nr_inode_items = ffi.new('uint32_t *')
+
+    def _reserve(self, nr_items):
+        if nr_items <= self.capacity:
+            return
+        for name, ctype in self.COLUMNS:
+            setattr(self, name, ffi.new('%s[]' % ctype, nr_items))
+        self._selected = ffi.new('uint32_t[]', nr_items)
+        self.capacity = nr_items
+
+    def decode(self, buf, buf_size, nr_items):
+        self._reserve(nr_items)
+        self._buf = buf
+        self.nr_items = lib.bedup_decode_search_buf(
+            buf, buf_size, nr_items, *[
+                getattr(self, name) for name, ctype in self.COLUMNS])
+        assert self.nr_items == nr_items, (self.nr_items, nr_items)
+
+    def key(self, i):
+        return (self.objectid[i], self.type[i], self.offset[i])
+
+    def item(self, i, ctype):
+        """A pointer to the data of item i, cast to ctype."""
+        return ffi.cast(ctype, self._buf + self.data_off[i])
+
+    def select_files(
+        self, size_cutoff, min_generation,
+        old_size_cutoff=0, old_min_generation=0,
+    ):
+        """Indexes of regular file inode items that pass the filters.
+
+        Inodes of size >= old_size_cutoff (if non-zero) need to have been
+        modified (their transid) since old_min_generation, the others
+        since min_generation.
+        Also returns the number of inode items in the batch.
+        """
+
+        nr_selected = lib.bedup_select_files(
+            self.nr_items, self.type,
+            self.inode_transid, self.inode_size, self.inode_mode,
+            size_cutoff, min_generation,
+            old_size_cutoff, old_min_generation,
+            self._selected, self._nr_inode_items)
+        return (
+            [self._selected[j] for j in xrange(nr_selected)],
+            self._nr_inode_items[0])
+
+
+class SearchBuffer(object):
+    """The items returned by one tree search ioctl.
+
+    Iterating yields search headers; the item data follows each header.
+    Both are only valid until the next search.
+    """
+
+    def __init__(self, buf, buf_size, nr_items):
+        self._buf = buf
+        self._buf_size = buf_size
+        self.nr_items = nr_items
+        self.last_key = None
+
+    def decode(self, batch):
+        """Decodes every item into batch, a SearchBatch, in one call."""
+
+        batch.decode(self._buf, self._buf_size, self.nr_items)
+        self.last_key = batch.key(self.nr_items - 1)
+        return batch
+
+    def __len__(self):
+        return self.nr_items
+
+    def __iter__(self):
+        offset = 0
+        for item_id in xrange(self.nr_items):
+            sh = ffi.cast(
+                'struct btrfs_ioctl_search_header *', self._buf + offset)
+            offset += ffi.sizeof('struct btrfs_ioctl_search_header') + sh.len
+            yield sh
+        self.last_key = (sh.objectid, sh.type, sh.offset)
+
+
+class TreeSearch(object):
+    """Walks the items of a btrfs tree, in key order.
+
+    tree_id = 0 searches the subvolume of volume_fd.
+    Keys are (objectid, type, offset) tuples; both bounds are inclusive.
+
+    Uses BTRFS_IOC_TREE_SEARCH_V2 with a buf_size result buffer,
+    falling back to the v1 ioctl (which returns at most about 4KiB of
+    items per call) on kernels older than 3.16.
+    The ioctl counters can be used to tune buf_size.
+
+    The kernel compares whole keys against the bounds, so a type range
+    doesn't filter out the other types of the objectids in between.
+    With skip_objectid_tail, a search that stopped in the middle of an
+    objectid's items resumes at the next objectid (with the type of
+    min_key), instead of fetching the rest of them.
+    """
+
+    def __init__(
+        self, volume_fd, tree_id=0,
+        min_key=(0, 0, 0), max_key=(U64_MAX, U8_MAX, U64_MAX),
+        min_transid=0, max_transid=U64_MAX,
+        buf_size=DEFAULT_TREE_SEARCH_BUF_SIZE, skip_objectid_tail=False,
+    ):
+        self.volume_fd = volume_fd
+        self.tree_id = tree_id
+        self.min_key = min_key
+        self.max_key = max_key
+        self.skip_objectid_tail = skip_objectid_tail
+        self._restart_type = min_key[1]
+        self.min_transid = min_transid
+        self.max_transid = max_transid
+        self.buf_size = min(buf_size, TREE_SEARCH_MAX_BUF_SIZE)
+
+        self.ioctl_count = 0
+        self.item_count = 0
+        self.ioctl_time = 0.
+        self.used_v2 = None
+
+        self._v1_args = None
+        self._v2_cbuf = None
+
+    def _fill_key(self, sk, nr_items):
+        sk.tree_id = self.tree_id
+        sk.min_objectid, sk.min_type, sk.min_offset = self.min_key
+        sk.max_objectid, sk.max_type, sk.max_offset = self.max_key
+        sk.min_transid = self.min_transid
+        sk.max_transid = self.max_transid
+        sk.nr_items = nr_items
+
+    def _search_v1(self):
+        if self._v1_args is None:
+            self._v1_args = ffi.new('struct btrfs_ioctl_search_args *')
+        args = self._v1_args
+        self._fill_key(args.key, 4096)
+        # May raise EPERM
+        ioctl_pybug(
+            self.volume_fd, lib.BTRFS_IOC_TREE_SEARCH, ffi.buffer(args))
+        return (
+            args.buf,
+            ffi.sizeof(args[0]) - ffi.sizeof('struct btrfs_ioctl_search_key'),
+            args.key.nr_items)
+
+    def _search_v2(self):
+        if self._v2_cbuf is None:
+            self._v2_cbuf = ffi.new(
+                'char[]',
+                ffi.sizeof('struct btrfs_ioctl_search_args_v2')
+                + self.buf_size)
+        args = ffi.cast(
+            'struct btrfs_ioctl_search_args_v2 *', self._v2_cbuf)
+        # The buffer size is the limit that matters
+        self._fill_key(args.key, U32_MAX)
+        args.buf_size = self.buf_size
+        try:
+            ioctl_pybug(
+                self.volume_fd, lib.BTRFS_IOC_TREE_SEARCH_V2,
+                ffi.buffer(self._v2_cbuf))
+        except IOError as err:
+            if err.errno != errno.EOVERFLOW:
+                raise
+            # A single item is larger than our buffer;
+            # the kernel told us how much room it needs.
+            if args.buf_size <= self.buf_size:
+                raise
+            self.buf_size = args.buf_size
+            self._v2_cbuf = None
+            return self._search_v2()
+        return ffi.cast('char *', args.buf), self.buf_size, args.key.nr_items
+
+    def _search(self):
+        global _has_tree_search_v2
+
+        start = monotonic_time()
+        if _has_tree_search_v2 is not False:
+            try:
+                rv = self._search_v2()
+            except IOError as err:
+                if err.errno != errno.ENOTTY or _has_tree_search_v2:
+                    raise
+                _has_tree_search_v2 = False
+                rv = self._search_v1()
+            else:
+                _has_tree_search_v2 = True
+        else:
+            rv = self._search_v1()
+        self.used_v2 = _has_tree_search_v2
+        self.ioctl_time += monotonic_time() - start
+        self.ioctl_count += 1
+        self.item_count += rv[2]
+        return rv
+
+    def next_key(self, last_key):
+        """The key the search resumes from, after a buffer ending at last_key.
+
+        Returns None when the search is complete.
+        """
+
+        # See
+        # https://btrfs.wiki.kernel.org/index.php/Btrfs_design#Btree_Data_structures
+        # and btrfs_key for the btree iteration order.
+        objectid, type_, offset = last_key
+        if self.skip_objectid_tail:
+            if objectid < U64_MAX:
+                key = (objectid + 1, self._restart_type, 0)
+            else:
+                return
+        elif offset < U64_MAX:
+            key = (objectid, type_, offset + 1)
+        elif type_ < U8_MAX:
+            key = (objectid, type_ + 1, 0)
+        elif objectid < U64_MAX:
+            key = (objectid + 1, 0, 0)
+        else:
+            return
+        if key > self.max_key:
+            return
+        return key
+
+    def buffers(self):
+        """Yields a SearchBuffer per ioctl, until the search is complete.
+        """
+
+        while True:
+            buf, buf_size, nr_items = self._search()
+            if nr_items == 0:
+                return
+            sbuf = SearchBuffer(buf, buf_size, nr_items)
+            yield sbuf
+            if sbuf.last_key is None:
+                # The caller didn't look at every item
+                for sh in sbuf:
+                    pass
+            self.min_key = self.next_key(sbuf.last_key)
+            if self.min_key is None:
+                return
+
+    def batches(self):
+        """Yields a decoded SearchBatch per ioctl.
+
+        The same SearchBatch is refilled every time.
+        """
+
+        batch = SearchBatch()
+        for sbuf in self.buffers():
+            yield sbuf.decode(batch)
+
+    def __iter__(self):
+        for sbuf in self.buffers():
+            for sh in sbuf:
+                yield sh
+
+    def describe_stats(self):
+        return '%d items in %d %s ioctls (%.2fs, %d-byte buffer)' % (
+            self.item_count, self.ioctl_count,
+            'v2' if self.used_v2 else 'v1', self.ioctl_time,
+            self.buf_size if self.used_v2 else 4096)
+
+
+def file_extents(search, ino):
+    """Yields a FileExtent for each EXTENT_DATA item of an inode.
+
+    search is a TreeSearch of the subvolume, which can be reused
+    from one inode to the next.
+    A zero disk_bytenr is a hole (without the no-holes feature).
+    """
+
+    search.min_key = (ino, lib.BTRFS_EXTENT_DATA_KEY, 0)
+    search.max_key = (ino, lib.BTRFS_EXTENT_DATA_KEY, U64_MAX)
+    for sh in search:
+        item = ffi.cast('struct btrfs_file_extent_item *', sh + 1)
+        type_ = lib.btrfs_stack_file_extent_type(item)
+        compression = lib.btrfs_stack_file_extent_compression(item)
+        if type_ == lib.BTRFS_FILE_EXTENT_INLINE:
+            yield FileExtent(sh.offset, type_, 0, 0, 0, 0, compression)
+            continue
+        yield FileExtent(
+            sh.offset, type_,
+            lib.btrfs_stack_file_extent_disk_bytenr(item),
+            lib.btrfs_stack_file_extent_disk_num_bytes(item),
+            lib.btrfs_stack_file_extent_offset(item),
+            lib.btrfs_stack_file_extent_num_bytes(item),
+            compression)
+
+
+def extent_csums(search, bytenr, length, sectorsize):
+    """The data checksums of a range of disk bytes, concatenated.
+
+    search is a TreeSearch of the csum tree, which can be reused.
+    bytenr must be sector-aligned.
+    Returns None if some sectors have no checksum (nodatasum files,
+    or data that isn't written yet).
+    """
+
+    end = bytenr + length
+    # Look back for an item that starts before the range
+    span = MAX_NODESIZE // CSUM_SIZE * sectorsize
+    search.min_key = (
+        lib.BTRFS_EXTENT_CSUM_OBJECTID, lib.BTRFS_EXTENT_CSUM_KEY,
+        max(0, bytenr - span))
+    search.max_key = (
+        lib.BTRFS_EXTENT_CSUM_OBJECTID, lib.BTRFS_EXTENT_CSUM_KEY, end - 1)
+    pos = bytenr
+    parts = []
+    for sh in search:
+        item_start = sh.offset
+        item_end = item_start + sh.len // CSUM_SIZE * sectorsize
+        if item_end <= pos:
+            continue
+        if item_start > pos:
+            return
+        first = (pos - item_start) // sectorsize
+        last = (min(end, item_end) - item_start - 1) // sectorsize + 1
+        parts.append(ffi.buffer(
+            ffi.cast('char *', sh + 1) + first * CSUM_SIZE,
+            (last - first) * CSUM_SIZE)[:])
+        pos = item_start + last * sectorsize
+        if pos >= end:
+            return b''.join(parts)
+
+
+def read_chunk_tree(volume_fd):
+    """Returns the Chunks of the filesystem, in logical order."""
+
+    search = TreeSearch(
+        volume_fd, tree_id=lib.BTRFS_CHUNK_TREE_OBJECTID,
+        min_key=(
+            lib.BTRFS_FIRST_CHUNK_TREE_OBJECTID, lib.BTRFS_CHUNK_ITEM_KEY, 0),
+        max_key=(
+            lib.BTRFS_FIRST_CHUNK_TREE_OBJECTID, lib.BTRFS_CHUNK_ITEM_KEY,
+            U64_MAX))
+    stripes_off = ffi.offsetof('struct btrfs_chunk', 'stripe')
+    stripe_size = ffi.sizeof('struct btrfs_stripe')
+    chunks = []
+    # May raise EPERM
+    for sh in search:
+        chunk = ffi.cast('struct btrfs_chunk *', sh + 1)
+        devids = []
+        for i in xrange(lib.btrfs_stack_chunk_num_stripes(chunk)):
+            stripe = ffi.cast(
+                'struct btrfs_stripe *',
+                ffi.cast('char *', chunk) + stripes_off + i * stripe_size)
+            devids.append(lib.btrfs_stack_stripe_devid(stripe))
+        chunks.append(Chunk(
+            sh.offset, lib.btrfs_stack_chunk_length(chunk), tuple(devids),
+            lib.btrfs_stack_chunk_type(chunk),
+            lib.btrfs_stack_chunk_stripe_len(chunk),
+            lib.btrfs_stack_chunk_sub_stripes(chunk)))
+    return chunks
+
+
 def lookup_ino_paths(volume_fd, ino, alloc_extra=0):  # pragma: no cover
     raise OSError('kernel bugs')
 
@@ -581,122 +1218,215 @@ def clone_data(dest, src, check_first):
     return True
 
 
-def defragment(fd):
-    # XXX Can remove compression as a side-effect
-    # Also, can unshare extents.
-    ioctl_pybug(fd, lib.BTRFS_IOC_DEFRAG)
+def clone_range(dest, src, src_offset, length, dest_offset):
+    """Makes a range of dest share the extents of a range of src.
 
+    Offsets and length must be aligned to the filesystem block size,
+    except for a range that ends at the end of src.
+    """
 
-def find_new(volume_fd, min_generation, results_file, terse, sep):
-    args = ffi.new('struct btrfs_ioctl_search_args *')
-    args_buffer = ffi.buffer(args)
-    sk = args.key
+    args = ffi.new('struct btrfs_ioctl_clone_range_args *')
+    args.src_fd = src
+    args.src_offset = src_offset
+    args.src_length = length
+    args.dest_offset = dest_offset
+    ioctl_pybug(dest, lib.BTRFS_IOC_CLONE_RANGE, ffi.buffer(args))
 
-    # Not a valid objectid that I know.
-    # But find-new uses that and it seems to work.
-    sk.tree_id = 0
 
-    sk.min_transid = min_generation
+# Older kernels silently dedupe no more than this per call
+EXTENT_SAME_MAX_LENGTH = 16 * 1024 ** 2
+# The kernel wants the arguments to fit in a page
+EXTENT_SAME_MAX_DESTS = 127
 
-    sk.max_objectid = u64_max
-    sk.max_offset = u64_max
-    sk.max_transid = u64_max
-    sk.max_type = lib.BTRFS_EXTENT_DATA_KEY
 
-    while True:
-        sk.nr_items = 4096
+def has_extent_same(fd):
+    """Whether the kernel has the extent-same ioctl (Linux 3.12)."""
 
-        # May raise EPERM
-        ioctl_pybug(
-            volume_fd, lib.BTRFS_IOC_TREE_SEARCH, args_buffer)
+    args = ffi.new('struct btrfs_ioctl_same_args *')
+    try:
+        # Rejected one way or another, but not with ENOTTY
+        # if the kernel knows the ioctl
+        ioctl_pybug(fd, lib.BTRFS_IOC_FILE_EXTENT_SAME, ffi.buffer(args))
+    except IOError as err:
+        return err.errno != errno.ENOTTY
+    return True
 
-        if sk.nr_items == 0:
-            break
 
-        offset = 0
-        for item_id in xrange(sk.nr_items):
-            sh = ffi.cast(
-                'struct btrfs_ioctl_search_header *', args.buf + offset)
-            offset += ffi.sizeof('struct btrfs_ioctl_search_header') + sh.len
+def extent_same(src, dests, length, src_offset=0, dest_offsets=None):
+    """Shares the extents of src with dests where the data is the same.
+
+    Compares length bytes from src_offset in src with the same range
+    in every dest, or the ranges starting at dest_offsets.
+
+    The kernel compares and dedupes under its own locks, so the files
+    don't need to be frozen first.
+    Requests cover up to EXTENT_SAME_MAX_LENGTH bytes and
+    EXTENT_SAME_MAX_DESTS destinations each.
+    Returns a dict of bytes deduped per destination fd; a destination
+    is dropped from the next requests once it differs or fails,
+    so anything short of length was only partially deduped.
+    Also returns a dict of the errno of destinations that failed rather
+    than differed (files it can't write to); a request that fails as
+    a whole fails for all of its destinations, and the others carry on.
+    Linux before 4.2 rejects lengths that aren't block-aligned, even up
+    to the end of the file; the aligned part is shared anyway, and the
+    tail is reported as EINVAL.
+    """
+
+    if dest_offsets is None:
+        dest_offsets = [src_offset] * len(dests)
+    dest_offsets = dict(zip(dests, dest_offsets))
+    deduped = dict.fromkeys(dests, 0)
+    errors = {}
+    active = list(dests)
+    block_size = None
+    offset = 0
+    while active and offset < length:
+        chunk_len = min(EXTENT_SAME_MAX_LENGTH, length - offset)
+        failed = set()
+        for i in xrange(0, len(active), EXTENT_SAME_MAX_DESTS):
+            batch = active[i:i + EXTENT_SAME_MAX_DESTS]
+            requests = dict(
+                (dest, dest_offsets[dest] + offset) for dest in batch)
+            results = _same_request(
+                src, src_offset + offset, requests, chunk_len)
+            retry = dict(
+                (dest, requests[dest]) for dest in batch
+                if results[dest][0] == -errno.EINVAL)
+            if retry:
+                if block_size is None:
+                    block_size = os.fstatvfs(src).f_bsize
+                aligned_len = chunk_len - chunk_len % block_size
+                if aligned_len and aligned_len != chunk_len:
+                    for dest, (status, bytes_deduped) in _same_request(
+                        src, src_offset + offset, retry, aligned_len
+                    ).iteritems():
+                        if status == 0 and bytes_deduped == aligned_len:
+                            # Only the tail is left over
+                            status = -errno.EINVAL
+                        results[dest] = status, bytes_deduped
+            for dest in batch:
+                status, bytes_deduped = results[dest]
+                if status <= 0:
+                    deduped[dest] += bytes_deduped
+                if status < 0:
+                    errors[dest] = -status
+                if status != 0 or bytes_deduped != chunk_len:
+                    failed.add(dest)
+        active = [dest for dest in active if dest not in failed]
+        offset += chunk_len
+    return deduped, errors
+
+
+def _same_request(src, src_offset, dest_offsets, length):
+    # One FILE_EXTENT_SAME ioctl; dest_offsets maps dest fds to offsets.
+    # Returns (status, bytes deduped) per dest, with a negative errno
+    # for every dest if the request fails as a whole.
+    dests = dest_offsets.keys()
+    cbuf = ffi.new(
+        'char[]',
+        ffi.sizeof('struct btrfs_ioctl_same_args')
+        + len(dests) * ffi.sizeof('struct btrfs_ioctl_same_extent_info'))
+    args = ffi.cast('struct btrfs_ioctl_same_args *', cbuf)
+    args.logical_offset = src_offset
+    args.length = length
+    args.dest_count = len(dests)
+    for j, dest in enumerate(dests):
+        args.info[j].fd = dest
+        args.info[j].logical_offset = dest_offsets[dest]
+    try:
+        ioctl_pybug(src, lib.BTRFS_IOC_FILE_EXTENT_SAME, ffi.buffer(cbuf))
+    except IOError as err:
+        return dict((dest, (-err.errno, 0)) for dest in dests)
+    return dict(
+        (dest, (args.info[j].status, args.info[j].bytes_deduped))
+        for j, dest in enumerate(dests))
 
-            # XXX The classic btrfs find-new looks only at extents,
-            # and doesn't find empty files or directories.
-            # Need to look at other types.
-            if sh.type == lib.BTRFS_EXTENT_DATA_KEY:
-                item = ffi.cast(
-                    'struct btrfs_file_extent_item *', sh + 1)
-                found_gen = lib.btrfs_stack_file_extent_generation(
-                    item)
-                if terse:
-                    name = lookup_ino_path_one(volume_fd, sh.objectid)
-                    results_file.write(name + sep)
-                else:
-                    results_file.write(
-                        'item type %d ino %d len %d gen0 %d gen1 %s%s' % (
-                            sh.type, sh.objectid, sh.len, sh.transid,
-                            found_gen, sep))
-                if found_gen < min_generation:
-                    continue
-            elif sh.type == lib.BTRFS_INODE_ITEM_KEY:
-                item = ffi.cast(
-                    'struct btrfs_inode_item *', sh + 1)
-                found_gen = lib.btrfs_stack_inode_generation(item)
-                if terse:
-                    # XXX sh.objectid must be wrong
-                    continue
-                    name = lookup_ino_path_one(volume_fd, sh.objectid)
-                    results_file.write(name + sep)
-                else:
-                    results_file.write(
-                        'item type %d ino %d len %d gen0 %d gen1 %d%s' % (
-                            sh.type, sh.objectid, sh.len, sh.transid,
-                            found_gen, sep))
-                if found_gen < min_generation:
-                    continue
-            elif sh.type == lib.BTRFS_INODE_REF_KEY:
-                ref = ffi.cast(
-                    'struct btrfs_inode_ref *', sh + 1)
-                name = name_of_inode_ref(ref)
-                if terse:
-                    # XXX short name
-                    continue
-                    results_file.write(name + sep)
-                else:
-                    results_file.write(
-                        'item type %d ino %d len %d gen0 %d name %s%s' % (
-                            sh.type, sh.objectid, sh.len, sh.transid,
-                            name, sep))
-            elif (sh.type == lib.BTRFS_DIR_ITEM_KEY
-                  or sh.type == lib.BTRFS_DIR_INDEX_KEY):
-                item = ffi.cast(
-                    'struct btrfs_dir_item *', sh + 1)
-                name = name_of_dir_item(item)
-                if terse:
-                    # XXX short name
-                    continue
-                    results_file.write(name + sep)
-                else:
-                    results_file.write(
-                        'item type %d dir ino %d len %d'
-                        ' gen0 %d gen1 %d type1 %d name %s%s' % (
-                            sh.type, sh.objectid, sh.len,
-                            sh.transid, item.transid, item.type, name, sep))
-            else:
-                if not terse:
-                    results_file.write(
-                        'item type %d oid %d len %d gen0 %d%s' % (
-                            sh.type, sh.objectid, sh.len, sh.transid, sep))
-        sk.min_objectid = sh.objectid
-        sk.min_type = sh.type
-        sk.min_offset = sh.offset
-
-        # CFFI 0.3 raises an OverflowError if necessary, no need to assert
-        #assert sk.min_offset < u64_max
-        # If the OverflowError actually happens in practice,
-        # we'll need to increase min_type resetting min_objectid to zero,
-        # then increase min_objectid resetting min_type and min_offset to zero.
-        # See
-        # https://btrfs.wiki.kernel.org/index.php/Btrfs_design#Btree_Data_structures
-        # and btrfs_key for the btree iteration order.
-        sk.min_offset += 1
 
+def defragment(fd):
+    # XXX Can remove compression as a side-effect
+    # Also, can unshare extents.
+    ioctl_pybug(fd, lib.BTRFS_IOC_DEFRAG)
+
+
+def find_new(
+    volume_fd, min_generation, results_file, terse, sep,
+    buf_size=DEFAULT_TREE_SEARCH_BUF_SIZE,
+):
+    # Not a valid objectid that I know.
+    # But find-new uses that and it seems to work.
+    search = TreeSearch(
+        volume_fd, tree_id=0, min_transid=min_generation,
+        max_key=(U64_MAX, lib.BTRFS_EXTENT_DATA_KEY, U64_MAX),
+        buf_size=buf_size)
+
+    # May raise EPERM
+    for batch in search.batches():
+        for i in xrange(batch.nr_items):
+            _find_new_item(
+                volume_fd, min_generation, results_file, terse, sep,
+                batch, i)
+
+
+def _find_new_item(
+    volume_fd, min_generation, results_file, terse, sep, batch, i
+):
+    item_type = batch.type[i]
+    objectid = batch.objectid[i]
+    item_len = batch.len[i]
+    transid = batch.transid[i]
+
+    # XXX The classic btrfs find-new looks only at extents,
+    # and doesn't find empty files or directories.
+    # Need to look at other types.
+    if item_type == lib.BTRFS_EXTENT_DATA_KEY:
+        item = batch.item(i, 'struct btrfs_file_extent_item *')
+        found_gen = lib.btrfs_stack_file_extent_generation(item)
+        if terse:
+            name = lookup_ino_path_one(volume_fd, objectid)
+            results_file.write(name + sep)
+        else:
+            results_file.write(
+                'item type %d ino %d len %d gen0 %d gen1 %s%s' % (
+                    item_type, objectid, item_len, transid, found_gen, sep))
+    elif item_type == lib.BTRFS_INODE_ITEM_KEY:
+        found_gen = batch.inode_generation[i]
+        if terse:
+            # XXX objectid must be wrong
+            return
+            name = lookup_ino_path_one(volume_fd, objectid)
+            results_file.write(name + sep)
+        else:
+            results_file.write(
+                'item type %d ino %d len %d gen0 %d gen1 %d%s' % (
+                    item_type, objectid, item_len, transid, found_gen, sep))
+    elif item_type == lib.BTRFS_INODE_REF_KEY:
+        ref = batch.item(i, 'struct btrfs_inode_ref *')
+        name = name_of_inode_ref(ref)
+        if terse:
+            # XXX short name
+            return
+            results_file.write(name + sep)
+        else:
+            results_file.write(
+                'item type %d ino %d len %d gen0 %d name %s%s' % (
+                    item_type, objectid, item_len, transid, name, sep))
+    elif (item_type == lib.BTRFS_DIR_ITEM_KEY
+          or item_type == lib.BTRFS_DIR_INDEX_KEY):
+        item = batch.item(i, 'struct btrfs_dir_item *')
+        name = name_of_dir_item(item)
+        if terse:
+            # XXX short name
+            return
+            results_file.write(name + sep)
+        else:
+            results_file.write(
+                'item type %d dir ino %d len %d'
+                ' gen0 %d gen1 %d type1 %d name %s%s' % (
+                    item_type, objectid, item_len,
+                    transid, item.transid, item.type, name, sep))
+    else:
+        if not terse:
+            results_file.write(
+                'item type %d oid %d len %d gen0 %d%s' % (
+                    item_type, objectid, item_len, transid, sep))
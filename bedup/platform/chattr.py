@@ -22,6 +22,7 @@ import fcntl
 __all__ = (
     'getflags',
     'editflags',
+    'getversion',
     'FS_IMMUTABLE_FL',
 )
 
@@ -29,6 +30,7 @@ ffi = FFI()
 ffi.cdef('''
 #define FS_IOC_GETFLAGS ...
 #define FS_IOC_SETFLAGS ...
+#define FS_IOC_GETVERSION ...
 
 #define	FS_SECRM_FL ... /* Secure deletion */
 #define	FS_UNRM_FL ... /* Undelete */
@@ -79,6 +81,19 @@ def getflags(fd):
     return flags_ptr[0]
 
 
+def getversion(fd):
+    """
+    Gets the inode generation number (as set by btrfs, ext4...).
+
+    The kernel only returns the low 32 bits.
+    """
+
+    gen_ptr = ffi.new('uint32_t*')
+    gen_buf = ffi.buffer(gen_ptr)
+    fcntl.ioctl(fd, lib.FS_IOC_GETVERSION, gen_buf)
+    return gen_ptr[0]
+
+
 def editflags(fd, add_flags=0, remove_flags=0):
     """
     Sets and unsets per-file filesystem flags.
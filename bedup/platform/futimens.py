@@ -35,6 +35,7 @@ struct timespec {
 struct stat {
     struct timespec st_atim;
     struct timespec st_mtim;
+    struct timespec st_ctim;
     ...;
 };
 
@@ -64,6 +65,17 @@ def fstat_ns(fd):
     return atime, mtime
 
 
+def change_times_ns(fd):
+    """The ctime and mtime of a file, as integer nanoseconds."""
+
+    stat = ffi.new('struct stat *')
+    if lib.fstat(fd, stat) != 0:
+        raise IOError(ffi.errno, os.strerror(ffi.errno), fd)
+    return tuple(
+        ts.tv_sec * 10 ** 9 + ts.tv_nsec
+        for ts in (stat.st_ctim, stat.st_mtim))
+
+
 def futimens(fd, ns):
     """
     set inode atime and mtime
@@ -38,6 +38,8 @@ int ioprio_set(int which, int who, int ioprio);
 int IOPRIO_PRIO_VALUE(int class, int data);
 int IOPRIO_PRIO_CLASS(int mask);
 int IOPRIO_PRIO_DATA(int mask);
+
+int bedup_gettid(void);
 ''')
 
 # Parts nabbed from schedutils/ionice.c
@@ -73,6 +75,11 @@ static inline int ioprio_set(int which, int who, int ioprio) {
 static inline int ioprio_get(int which, int who) {
     return syscall(SYS_ioprio_get, which, who);
 }
+
+/* glibc only has a wrapper since 2.30 */
+static inline int bedup_gettid(void) {
+    return syscall(SYS_gettid);
+}
 ''', ext_package='bedup')
 
 
@@ -89,3 +96,13 @@ def set_idle_priority(pid=None):
         lib.IOPRIO_WHO_PROCESS, pid,
         lib.IOPRIO_PRIO_VALUE(lib.IOPRIO_CLASS_IDLE, 0))
 
+
+def gettid():
+    """
+    Gets the id of the current thread.
+
+    Can be passed to set_idle_priority, which otherwise applies to
+    the main thread only.
+    """
+
+    return lib.bedup_gettid()
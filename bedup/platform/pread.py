@@ -0,0 +1,173 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import mmap
+import os
+import re
+import string
+
+from cffi import FFI
+
+__all__ = (
+    'aligned_buffer',
+    'pread',
+    'memeq',
+    'fadvise',
+    'resident_runs',
+    'ALIGNMENT',
+    'PAGE_SIZE',
+    'POSIX_FADV_SEQUENTIAL',
+    'POSIX_FADV_DONTNEED',
+)
+
+ffi = FFI()
+ffi.cdef('''
+    int posix_memalign(void **memptr, size_t alignment, size_t size);
+    void free(void *ptr);
+    int memcmp(const void *s1, const void *s2, size_t n);
+    ssize_t bedup_pread(int fd, char *buf, size_t count, int64_t offset);
+    int bedup_fadvise(int fd, int64_t offset, int64_t len, int advice);
+    int bedup_mincore(
+        int fd, int64_t offset, size_t length, unsigned char *vec);
+
+    #define POSIX_FADV_SEQUENTIAL ...
+    #define POSIX_FADV_DONTNEED ...
+''')
+lib = ffi.verify('''
+    #define _FILE_OFFSET_BITS 64
+    #include <fcntl.h>
+    #include <stdlib.h>
+    #include <string.h>
+    #include <sys/mman.h>
+    #include <unistd.h>
+
+    /* off_t isn't known to cffi */
+    static ssize_t bedup_pread(
+        int fd, char *buf, size_t count, int64_t offset)
+    {
+        return pread(fd, buf, count, offset);
+    }
+
+    static int bedup_fadvise(int fd, int64_t offset, int64_t len, int advice)
+    {
+        return posix_fadvise(fd, offset, len, advice);
+    }
+
+    /* Returns an errno, like posix_fadvise */
+    static int bedup_mincore(
+        int fd, int64_t offset, size_t length, unsigned char *vec)
+    {
+        void *addr;
+        int err = 0;
+
+        addr = mmap(NULL, length, PROT_READ, MAP_SHARED, fd, offset);
+        if (addr == MAP_FAILED)
+            return errno;
+        if (mincore(addr, length, vec) != 0)
+            err = errno;
+        munmap(addr, length);
+        return err;
+    }
+    ''', ext_package='bedup')
+
+# Enough for O_DIRECT on common block devices
+ALIGNMENT = 4096
+
+POSIX_FADV_SEQUENTIAL = lib.POSIX_FADV_SEQUENTIAL
+POSIX_FADV_DONTNEED = lib.POSIX_FADV_DONTNEED
+
+PAGE_SIZE = mmap.PAGESIZE
+
+# mincore is called on windows this large, to bound the size of its vector
+MINCORE_WINDOW = 1024 ** 3
+
+# Only the low bit of each mincore byte is defined
+_RESIDENT_BYTES = string.maketrans(
+    ''.join(map(chr, xrange(256))), '\x00\x01' * 128)
+
+
+def aligned_buffer(size, alignment=ALIGNMENT):
+    """
+    Allocates a char buffer whose address is a multiple of alignment.
+
+    The buffer is freed when the returned cdata is garbage-collected.
+    """
+
+    ptr = ffi.new('void **')
+    err = lib.posix_memalign(ptr, alignment, size)
+    if err != 0:
+        raise MemoryError(os.strerror(err), size)
+    return ffi.gc(ffi.cast('char *', ptr[0]), lib.free)
+
+
+def pread(fd, cbuf, size, offset):
+    """
+    Reads up to size bytes at offset into cbuf, without moving
+    the file position.
+
+    Returns the number of bytes read, 0 at end of file.
+    """
+
+    while True:
+        count = lib.bedup_pread(fd, cbuf, size, offset)
+        if count >= 0:
+            return count
+        if ffi.errno != errno.EINTR:
+            raise IOError(ffi.errno, os.strerror(ffi.errno), fd)
+
+
+def memeq(cbuf1, cbuf2, size):
+    return lib.memcmp(cbuf1, cbuf2, size) == 0
+
+
+def fadvise(fd, offset, length, advice):
+    """posix_fadvise; a length of 0 means up to the end of the file."""
+
+    err = lib.bedup_fadvise(fd, offset, length, advice)
+    if err != 0:
+        raise IOError(err, os.strerror(err), fd)
+
+
+def resident_runs(fd, offset, length):
+    """
+    Yields (start, end) for the parts of a file range whose pages
+    are in the page cache, in order.
+
+    offset must be a multiple of PAGE_SIZE.
+    """
+
+    end = offset + length
+    run_start = run_end = None
+    while offset < end:
+        size = min(MINCORE_WINDOW, end - offset)
+        vec = ffi.new('unsigned char[]', -(-size // PAGE_SIZE))
+        err = lib.bedup_mincore(fd, offset, size, vec)
+        if err != 0:
+            raise IOError(err, os.strerror(err), fd)
+        pages = ffi.buffer(vec)[:].translate(_RESIDENT_BYTES)
+        for match in re.finditer('\x01+', pages):
+            start = offset + match.start() * PAGE_SIZE
+            if start != run_end:
+                if run_start is not None:
+                    yield run_start, run_end
+                run_start = start
+            run_end = min(offset + match.end() * PAGE_SIZE, end)
+        offset += size
+    if run_start is not None:
+        yield run_start, run_end
@@ -0,0 +1,434 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import copy
+import errno
+import fcntl
+import hashlib
+import os
+import threading
+
+from .platform.pread import (
+    aligned_buffer, fadvise, pread, memeq, resident_runs, ALIGNMENT, ffi,
+    PAGE_SIZE, POSIX_FADV_DONTNEED, POSIX_FADV_SEQUENTIAL)
+from .platform.time import monotonic_time
+
+
+DEFAULT_READ_BUFFER_SIZE = 4 * 1024 ** 2
+MAX_READ_BUFFER_SIZE = 64 * 1024 ** 2
+
+# The per-read size before we had a Reader
+LEGACY_BUFSIZE = 8192
+
+# Linux 3.1; Python 3.3 has them in os
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+# cached: plain reads, the data stays in the page cache.
+# fadvise: sequential readahead, dropping what we brought into the cache.
+# direct: O_DIRECT, bypassing the page cache where the kernel can.
+READ_STRATEGIES = ('cached', 'fadvise', 'direct')
+DEFAULT_READ_STRATEGY = 'cached'
+
+
+def data_regions(fd, size):
+    """Yields (start, end) for the parts of the file that aren't holes.
+
+    Moves the file position.
+    Without SEEK_DATA support, the whole file is a single region.
+    """
+
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole after offset
+                return
+            if e.errno == errno.EINVAL and offset == 0:
+                yield 0, size
+                return
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        yield start, min(end, size)
+        offset = end
+
+
+def _pread_full(fd, cbuf, offset, size):
+    count = 0
+    while count < size:
+        count1 = pread(fd, cbuf + count, size - count, offset + count)
+        if not count1:
+            break
+        count += count1
+    return count
+
+
+def _set_direct(fd, direct):
+    # Returns False if the file doesn't support O_DIRECT
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    if bool(flags & os.O_DIRECT) == direct:
+        return True
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags ^ os.O_DIRECT)
+    except IOError as e:
+        if e.errno != errno.EINVAL:
+            raise
+        return False
+    return True
+
+
+def _pread_direct(fd, cbuf, offset, size):
+    # Like _pread_full, with O_DIRECT.  The read is rounded up
+    # to the alignment, cbuf must have room for that.
+    # Returns None when the read has to be buffered.
+    if offset % ALIGNMENT or not _set_direct(fd, True):
+        _set_direct(fd, False)
+        return
+    try:
+        count = _pread_full(fd, cbuf, offset, size + -size % ALIGNMENT)
+    except IOError as e:
+        # A short read in the middle of the file leaves us unaligned
+        if e.errno != errno.EINVAL:
+            raise
+        _set_direct(fd, False)
+        return
+    return min(count, size)
+
+
+def page_cache_size():
+    """The size of the page cache in bytes, or None if unknown."""
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('Cached:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return
+
+
+class Reader(object):
+    """Reads whole files through large, reusable, aligned buffers.
+
+    Files are read with pread, so their position isn't used or changed.
+    Buffers are allocated per thread on first use; a single Reader
+    can be shared by a pool of hashing threads.
+
+    With the fadvise and direct strategies, reading files doesn't evict
+    the working set of other programs from the page cache.  The fadvise
+    strategy keeps the pages of a file that were cached before its first
+    read, and drops the others after reading them.
+    The direct strategy sets O_DIRECT on the files it reads.
+
+    Every read call goes through throttle, a ReadThrottle, if given,
+    and pauses while the system is under pressure.
+    Readers returned by locked don't wait for the throttle or pause,
+    they are for reading files while holding them locked.
+    """
+
+    def __init__(
+        self, buf_size=DEFAULT_READ_BUFFER_SIZE,
+        strategy=DEFAULT_READ_STRATEGY, throttle=None,
+    ):
+        assert strategy in READ_STRATEGIES, strategy
+        buf_size = min(buf_size, MAX_READ_BUFFER_SIZE)
+        self.buf_size = max(ALIGNMENT, buf_size - buf_size % ALIGNMENT)
+        self.strategy = strategy
+        self.throttle = throttle
+        self.wait_for_throttle = True
+        self._local = threading.local()
+        # fd -> ((st_dev, st_ino), run ends, runs) for the fadvise strategy
+        self._cached_before = {}
+        self._cached_before_lock = threading.Lock()
+
+    def _zeros(self):
+        try:
+            return self._local.zeros
+        except AttributeError:
+            # ffi.new zero-fills
+            self._local.zeros = ffi.new('char[]', self.buf_size)
+            return self._local.zeros
+
+    def _buffers(self):
+        try:
+            return self._local.buffers
+        except AttributeError:
+            # Two, so that cmp_files can hold a chunk of each file
+            self._local.buffers = (
+                aligned_buffer(self.buf_size), aligned_buffer(self.buf_size))
+            return self._local.buffers
+
+    def _read(self, fd, cbuf, offset, size=None):
+        # Fills cbuf (or its first size bytes),
+        # unless we reach the end of the file
+        if size is None:
+            size = self.buf_size
+        if self.throttle is not None and self.wait_for_throttle:
+            self.throttle.pause()
+            self.throttle.wait()
+        count = None
+        if self.strategy == 'direct':
+            count = _pread_direct(fd, cbuf, offset, size)
+        elif self.strategy == 'fadvise':
+            cached_before = self._cached_runs(fd)
+        if count is None:
+            count = _pread_full(fd, cbuf, offset, size)
+        if self.strategy == 'fadvise' and count:
+            self._drop_pages(fd, offset, count, cached_before)
+        if self.throttle is not None:
+            self.throttle.charge(count)
+        return count
+
+    def locked(self):
+        """A Reader that shares buffers and throttle with this one,
+        and doesn't pause or wait for the throttle before reading.
+
+        Its reads are still charged, the reads of this Reader
+        wait for them.
+        """
+
+        rv = copy.copy(self)
+        rv.wait_for_throttle = False
+        return rv
+
+    def _cached_runs(self, fd):
+        # The parts of the file that were in the page cache before
+        # we first read it.  The file is set up for sequential reads
+        # at the same time.
+        st = os.fstat(fd)
+        key = st.st_dev, st.st_ino
+        with self._cached_before_lock:
+            entry = self._cached_before.get(fd)
+        if entry is not None and entry[0] == key:
+            return entry[1:]
+        runs = list(resident_runs(fd, 0, st.st_size))
+        fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        entry = key, [end for start, end in runs], runs
+        with self._cached_before_lock:
+            self._cached_before[fd] = entry
+        return entry[1:]
+
+    def _drop_pages(self, fd, offset, count, cached_before):
+        # Drops the pages of the range that weren't cached before
+        ends, runs = cached_before
+        start = offset - offset % PAGE_SIZE
+        end = offset + count
+        i = bisect.bisect_right(ends, start)
+        while i < len(runs) and runs[i][0] < end:
+            run_start, run_end = runs[i]
+            if run_start > start:
+                fadvise(fd, start, run_start - start, POSIX_FADV_DONTNEED)
+            start = run_end
+            i += 1
+        if start < end:
+            fadvise(fd, start, end - start, POSIX_FADV_DONTNEED)
+
+    def chunks(self, fd, offset=0, end=None):
+        """Yields (cbuf, count) for the file contents from offset
+        to end (or to the end of the file).
+
+        cbuf is overwritten at the next iteration.
+        """
+
+        cbuf = self._buffers()[0]
+        while end is None or offset < end:
+            if end is None:
+                size = self.buf_size
+            else:
+                size = min(self.buf_size, end - offset)
+            count = self._read(fd, cbuf, offset, size)
+            if not count:
+                return
+            yield cbuf, count
+            offset += count
+
+    def hash_range(self, fd, hasher, offset=0, end=None):
+        """Feeds the file contents from offset to end to hasher.
+
+        Returns the number of bytes read.
+        """
+
+        read = 0
+        for cbuf, count in self.chunks(fd, offset, end):
+            hasher.update(ffi.buffer(cbuf, count))
+            read += count
+        return read
+
+    def hash_file(self, fd, hasher=None):
+        """Returns the hex SHA1 (or hasher's) digest of the file."""
+
+        if hasher is None:
+            hasher = hashlib.sha1()
+        self.hash_range(fd, hasher)
+        return hasher.hexdigest()
+
+    def _lockstep_buffers(self, count):
+        try:
+            buffers = self._local.lockstep_buffers
+        except AttributeError:
+            buffers = self._local.lockstep_buffers = []
+        while len(buffers) < count:
+            buffers.append(aligned_buffer(self.buf_size))
+        return buffers[:count]
+
+    def partition(self, fds, read_map=map, layouts=None):
+        """Splits files into classes with identical contents.
+
+        All files are read in lockstep, one buffer at a time (read_map
+        can be a thread pool's map); a file stops being read as soon as
+        its contents differ from all others.
+        With layouts, which maps files to objects whose physical method
+        gives the disk position of an offset, each round of reads is
+        done from this thread in disk order instead.
+        Returns the classes that have more than one file.
+        """
+
+        cbufs = dict(zip(fds, self._lockstep_buffers(len(fds))))
+        groups = [list(fds)]
+        identical = []
+        offset = 0
+        while groups:
+            active = [fd for group in groups for fd in group]
+            if layouts is not None:
+                active.sort(key=lambda fd: layouts[fd].physical(offset))
+                read_map = map
+            counts = dict(zip(active, read_map(
+                lambda fd: self._read(fd, cbufs[fd], offset), active)))
+            split_groups = []
+            for group in groups:
+                classes = []
+                for fd in group:
+                    for cls in classes:
+                        fd1 = cls[0]
+                        if counts[fd] == counts[fd1] and memeq(
+                            cbufs[fd], cbufs[fd1], counts[fd]
+                        ):
+                            cls.append(fd)
+                            break
+                    else:
+                        classes.append([fd])
+                for cls in classes:
+                    if len(cls) < 2:
+                        continue
+                    if counts[cls[0]]:
+                        split_groups.append(cls)
+                    else:
+                        identical.append(cls)
+            groups = split_groups
+            offset += self.buf_size
+        return identical
+
+    def cmp_ranges(self, fd1, offset1, fd2, offset2, length):
+        """Whether two ranges have the same contents.
+
+        False if either range goes past the end of its file.
+        """
+
+        cbuf1, cbuf2 = self._buffers()
+        done = 0
+        while done < length:
+            size = min(self.buf_size, length - done)
+            if self._read(fd1, cbuf1, offset1 + done, size) != size:
+                return False
+            if self._read(fd2, cbuf2, offset2 + done, size) != size:
+                return False
+            if not memeq(cbuf1, cbuf2, size):
+                return False
+            done += size
+        return True
+
+    def is_zero(self, fd):
+        """Whether the file only contains zeroes.
+
+        Holes are skipped without being read.
+        """
+
+        zeros = self._zeros()
+        for start, end in data_regions(fd, os.fstat(fd).st_size):
+            for cbuf, count in self.chunks(fd, start, end):
+                if not memeq(cbuf, zeros, count):
+                    return False
+        return True
+
+    def cmp_files(self, fd1, fd2):
+        """Whether both files have the same contents."""
+
+        cbuf1, cbuf2 = self._buffers()
+        offset = 0
+        while True:
+            count1 = self._read(fd1, cbuf1, offset)
+            count2 = self._read(fd2, cbuf2, offset)
+            if count1 != count2 or not memeq(cbuf1, cbuf2, count1):
+                return False
+            if not count1:
+                return True
+            offset += count1
+
+
+# Buffers are only allocated by threads that use it
+default_reader = Reader()
+
+
+def _legacy_hash_file(fd):
+    hasher = hashlib.sha1()
+    with os.fdopen(os.dup(fd), 'rb') as afile:
+        for buf in iter(lambda: afile.read(LEGACY_BUFSIZE), b''):
+            hasher.update(buf)
+    return hasher.hexdigest()
+
+
+def bench_read(paths, buf_sizes, repeat=3, strategy=DEFAULT_READ_STRATEGY):
+    """Times hashing and comparing files with various buffer sizes.
+
+    Yields (description, seconds, bytes) for the best of repeat runs.
+    The first run may populate the page cache; drop caches in between
+    to measure cold reads.
+    """
+
+    fds = [os.open(path, os.O_RDONLY) for path in paths]
+    try:
+        total_size = sum(os.fstat(fd).st_size for fd in fds)
+        cases = [
+            ('hash, %d-byte file reads' % LEGACY_BUFSIZE,
+             lambda: [_legacy_hash_file(fd) for fd in fds], total_size)]
+        for buf_size in buf_sizes:
+            reader = Reader(buf_size, strategy)
+            cases.append((
+                'hash, %d-byte buffer' % reader.buf_size,
+                lambda reader=reader: [reader.hash_file(fd) for fd in fds],
+                total_size))
+            if len(fds) > 1:
+                cases.append((
+                    'cmp, %d-byte buffer' % reader.buf_size,
+                    lambda reader=reader: reader.cmp_files(fds[0], fds[1]),
+                    2 * os.fstat(fds[0]).st_size))
+        for desc, fn, size in cases:
+            best = None
+            for i in xrange(repeat):
+                start = monotonic_time()
+                fn()
+                elapsed = monotonic_time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            yield desc, best, size
+    finally:
+        for fd in fds:
+            os.close(fd)
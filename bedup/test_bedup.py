@@ -1,4 +1,5 @@
 
+import hashlib
 import multiprocessing
 import os
 import shutil
@@ -6,12 +7,23 @@ import subprocess
 import tempfile
 
 import pytest
+import sqlalchemy
+
+from sqlalchemy.orm import sessionmaker
 
 from .platform.syncfs import syncfs
-from .platform.btrfs import lookup_ino_paths, BTRFS_FIRST_FREE_OBJECTID
+from .platform.btrfs import (
+    extent_csums, ffi as btrfs_ffi, lib as btrfs_lib, lookup_ino_paths,
+    Chunk, BTRFS_FIRST_FREE_OBJECTID)
 
 from .__main__ import main
+from .blocks import find_ranges, BlockRange, BLOCK_SIZE
+from .devices import stripe_index
+from .model import META, BlockDigest, Inode
+from .reading import Reader
+from .tracking import elevator_hash_range, progressive_hash, upsert_inodes
 from . import compat  # monkey-patch check_output in py2.6
+from . import throttle
 
 # Placate pyflakes
 db = fs = fsimage = sampledata1 = sampledata2 = vol_fd = None
@@ -95,9 +107,19 @@ def test_functional():
     with open(fs + '/one.sample', 'r+') as busy_file:
         with open(fs + '/three.sample', 'r+') as busy_file:
             boxed_call('dedup --'.split() + [fs])
+            boxed_call(
+                'dedup --csum-fingerprints --read-strategy=fadvise'.split()
+                + ['--per-device-reads', '--', fs])
     boxed_call('reset --'.split() + [fs])
     boxed_call('scan --size-cutoff=65536 --'.split() + [fs, fs])
     boxed_call('dedup --'.split() + [fs])
+    boxed_call('reset --'.split() + [fs])
+    boxed_call(
+        'scan --size-cutoff=65536 --jobs=2 --scan-extents --'.split()
+        + [fs, fs])
+    boxed_call(
+        'dedup --hash-threads=2 --dedup-backend=extent-same --blocks'.split()
+        + ['--max-read-rate=%d' % 1024 ** 3, '--', fs])
     boxed_call(
         'dedup-files --defragment --'.split() +
         [fs + '/one.sample', fs + '/two.sample'])
@@ -110,7 +132,7 @@ def test_functional():
     stat1 = stat(fs + '/one.sample')
     # Check that atime and mtime are restored
     assert stat0 == stat1
-    boxed_call('find-new --'.split() + [fs])
+    boxed_call('find-new --search-buf-size=65536 --'.split() + [fs])
     boxed_call('show'.split())
 
 
@@ -123,6 +145,376 @@ def test_lookup_ino_paths():
         lookup_ino_paths(vol_fd, BTRFS_FIRST_FREE_OBJECTID)) == ('/', )
 
 
+def mk_session():
+    engine = sqlalchemy.create_engine('sqlite://')
+    META.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def inode_row(**kwargs):
+    row = dict(
+        b_vol_id=1, b_ino=257, b_size=4096, b_generation=5, b_transid=10,
+        b_mtime=1000)
+    row.update(('b_' + key, val) for key, val in kwargs.iteritems())
+    return row
+
+
+def test_upsert_inodes():
+    sess = mk_session()
+    upsert_inodes(sess, [inode_row()])
+    inode = sess.query(Inode).one()
+    assert inode.has_updates
+    inode.has_updates = False
+    inode.mini_hash = 42
+    inode.fiemap_hash = 43
+    inode.block_transid = 10
+    sess.commit()
+
+    # Metadata only (permissions, xattrs, our immutable flag)
+    upsert_inodes(sess, [inode_row(transid=11)])
+    sess.expire_all()
+    assert not inode.has_updates
+    assert inode.mini_hash == 42
+    assert inode.block_transid == 11
+    # Defragmenting doesn't change the mtime
+    assert inode.fiemap_hash is None
+
+    # The data changed
+    inode.fiemap_hash = 43
+    sess.commit()
+    upsert_inodes(sess, [inode_row(transid=12, mtime=2000)])
+    sess.expire_all()
+    assert inode.has_updates
+    assert inode.mini_hash is None
+    assert inode.fiemap_hash is None
+    assert inode.transid == 12
+    assert inode.block_transid == 11
+
+    # The inode number was reused
+    inode.has_updates = False
+    inode.mini_hash = 42
+    sess.commit()
+    upsert_inodes(sess, [inode_row(generation=6, transid=13, mtime=2000)])
+    sess.expire_all()
+    assert inode.has_updates
+    assert inode.mini_hash is None
+    assert inode.generation == 6
+
+
+def open_samples(tmpdir, contents):
+    fds = []
+    for i, data in enumerate(contents):
+        path = tmpdir.join('sample%d' % i)
+        path.write(data, mode='wb')
+        fds.append(os.open(str(path), os.O_RDONLY))
+    return fds
+
+
+def test_progressive_hash(tmpdir):
+    size = 1024 ** 2 + 4096
+    data = os.urandom(size)
+    fds = open_samples(tmpdir, [
+        data, data, data[:-1] + b'x', b'x' + data[1:]])
+    try:
+        reader = Reader(64 * 1024)
+        digests = progressive_hash(reader, fds, size)
+        # The last file differs within the first tier and is dropped,
+        # the third only in the last one
+        assert sorted(digests) == sorted(fds[:3])
+        assert digests[fds[0]] == hashlib.sha1(data).hexdigest()
+        assert digests[fds[1]] == digests[fds[0]]
+        assert digests[fds[2]] != digests[fds[0]]
+        digests = progressive_hash(reader, fds, size, keep_singletons=True)
+        assert sorted(digests) == sorted(fds)
+        assert progressive_hash(reader, fds[:1], size) == {}
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def test_partition(tmpdir):
+    data = os.urandom(3 * 4096 + 100)
+    fds = open_samples(tmpdir, [
+        data, data[:-1] + b'x', data, b'x' + data[1:], data[:-1] + b'x',
+        data[:-100]])
+    try:
+        reader = Reader(4096)
+        classes = reader.partition(fds)
+        assert sorted(sorted(cls) for cls in classes) == [
+            sorted([fds[0], fds[2]]), sorted([fds[1], fds[4]])]
+        assert reader.partition(fds[3:4]) == []
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def test_find_ranges():
+    sess = mk_session()
+    src, dest, other = (1, 300), (1, 301), (1, 302)
+    blocks = [
+        (src, 0, 1), (src, 1, 2), (src, 2, 3), (src, 5, 4),
+        (dest, 1, 1), (dest, 2, 2), (dest, 3, 4), (dest, 4, 5),
+        (other, 0, 1), (other, 1, 5)]
+    sess.execute(BlockDigest.__table__.insert(), [
+        dict(vol_id=vol_id, ino=ino, offset=i * BLOCK_SIZE, digest=digest)
+        for (vol_id, ino), i, digest in blocks])
+    # dest was just digested, src and other were before
+    ranges = find_ranges(sess, [1], set([dest]), set([1, 2, 4, 5]))
+    # Contiguous blocks of the same source are merged,
+    # pairs that were both digested before are left alone
+    assert ranges == {
+        dest: [
+            BlockRange(BLOCK_SIZE, 1, 300, 0, 2 * BLOCK_SIZE),
+            BlockRange(3 * BLOCK_SIZE, 1, 300, 5 * BLOCK_SIZE, BLOCK_SIZE),
+            BlockRange(4 * BLOCK_SIZE, 1, 302, BLOCK_SIZE, BLOCK_SIZE)]}
+
+
+class FakeCsumSearch(object):
+    """Stands in for a TreeSearch of the csum tree."""
+
+    def __init__(self, items):
+        hdr_size = btrfs_ffi.sizeof('struct btrfs_ioctl_search_header')
+        self._bufs = []
+        for offset, csums in items:
+            buf = btrfs_ffi.new('char[]', hdr_size + len(csums))
+            sh = btrfs_ffi.cast('struct btrfs_ioctl_search_header *', buf)
+            sh.offset = offset
+            sh.len = len(csums)
+            btrfs_ffi.buffer(buf + hdr_size, len(csums))[:] = csums
+            self._bufs.append((buf, sh))
+
+    def __iter__(self):
+        for buf, sh in self._bufs:
+            if sh.offset > self.max_key[2]:
+                return
+            yield sh
+
+
+def test_extent_csums():
+    # Checksums are four bytes per sector
+    search = FakeCsumSearch([
+        (0, b'aaaabbbbccccdddd'), (16384, b'eeeeffffgggg')])
+    # Slices the first item and the start of the next one
+    assert extent_csums(search, 8192, 16384, 4096) == b'ccccddddeeeeffff'
+    assert extent_csums(search, 4096, 4096, 4096) == b'bbbb'
+    # Past the last checksum
+    assert extent_csums(search, 24576, 8192, 4096) is None
+    # A gap between items
+    search = FakeCsumSearch([(0, b'aaaabbbb'), (12288, b'dddd')])
+    assert extent_csums(search, 0, 16384, 4096) is None
+    # Across three items
+    search = FakeCsumSearch([
+        (0, b'aaaabbbb'), (8192, b'cccc'), (12288, b'ddddeeee')])
+    assert extent_csums(search, 4096, 12288, 4096) == b'bbbbccccdddd'
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+        self.sleeps = []
+
+    def monotonic_time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+def test_read_throttle(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle, 'monotonic_time', clock.monotonic_time)
+    monkeypatch.setattr(throttle.time, 'sleep', clock.sleep)
+    mib = 1024 ** 2
+
+    rt = throttle.ReadThrottle(max_rate=mib)
+    # The bucket starts full
+    rt.wait()
+    assert clock.sleeps == []
+    # A read can go over the limit, the next one waits for it
+    rt.charge(3 * mib)
+    rt.wait()
+    assert clock.sleeps == [2.]
+    # The bucket holds at most a second's worth
+    clock.now += 10
+    rt.charge(2 * mib)
+    rt.wait()
+    assert clock.sleeps == [2., 1.]
+    rt.scale(.5)
+    assert rt.max_rate == mib // 2
+    rt.charge(mib // 2)
+    rt.wait()
+    assert clock.sleeps == [2., 1., 1.]
+    rt.scale(1e-9)
+    assert rt.max_rate == throttle.MIN_READ_RATE
+
+    rt = throttle.ReadThrottle(max_iops=2)
+    for i in range(3):
+        rt.charge(0)
+    rt.wait()
+    assert clock.sleeps[-1] == .5
+
+    # Scaling down sets a limit from the measured rate
+    rt = throttle.ReadThrottle()
+    rt.charge(4 * mib)
+    clock.now += 1
+    rt.charge(0)
+    assert rt.rate == 4 * mib
+    rt.scale(.5)
+    assert rt.max_rate == 2 * mib
+
+
+class FakeThrottle(object):
+    def __init__(self):
+        self.calls = []
+
+    def pause(self):
+        self.calls.append('pause')
+
+    def wait(self):
+        self.calls.append('wait')
+
+    def charge(self, size):
+        self.calls.append(('charge', size))
+
+
+def test_reader_pauses(tmpdir):
+    fds = open_samples(tmpdir, [b'x' * 100])
+    try:
+        rt = FakeThrottle()
+        reader = Reader(4096, throttle=rt)
+        cbuf = reader._buffers()[0]
+        # Reads made before locking pause for pressure
+        assert reader._read(fds[0], cbuf, 0) == 100
+        assert rt.calls == ['pause', 'wait', ('charge', 100)]
+        # Reads of locked files are only charged
+        rt.calls = []
+        assert reader.locked()._read(fds[0], cbuf, 0) == 100
+        assert rt.calls == [('charge', 100)]
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def test_pressure(monkeypatch, tmpdir):
+    clock = FakeClock()
+    monkeypatch.setattr(throttle, 'monotonic_time', clock.monotonic_time)
+    monkeypatch.setattr(
+        throttle, 'PRESSURE_PATH', str(tmpdir.join('%s')))
+    psi = tmpdir.join('io')
+    psi.write(
+        'some avg10=12.50 avg60=3.00 avg300=1.00 total=123456\n'
+        'full avg10=40.00 avg60=2.00 avg300=0.50 total=4567\n')
+    assert throttle.read_pressure('io') == 12.5
+    assert throttle.read_pressure('memory') is None
+
+    monitor = throttle.PressureMonitor(dict(io=10, memory=10, cpu=None))
+    assert monitor.thresholds == dict(io=10)
+    assert monitor.unavailable == ['memory']
+
+    def sleep(delay):
+        clock.sleep(delay)
+        psi.write('some avg10=0.00 avg60=0.00 avg300=0.00 total=123456\n')
+    monkeypatch.setattr(throttle.time, 'sleep', sleep)
+    monitor.wait()
+    assert clock.sleeps == [throttle.PRESSURE_PAUSE_INTERVAL]
+    assert monitor.pauses == 1
+    assert not monitor.paused
+
+
+class FakeLayout(object):
+    def __init__(self, physical):
+        self.physical = physical
+
+
+class FakeReader(object):
+    buf_size = 10
+
+    def __init__(self):
+        self.reads = []
+
+    def hash_range(self, fd, hasher, offset, end):
+        self.reads.append((fd, offset))
+        return end - offset
+
+
+def test_elevator_order():
+    reader = FakeReader()
+    fds = [1, 2, 3]
+    layouts = {
+        1: FakeLayout(lambda offset: 1000 + offset),
+        2: FakeLayout(lambda offset: offset),
+        # The second chunk is behind the others
+        3: FakeLayout(lambda offset: 500 + offset if offset < 10 else 0),
+    }
+    hashers = dict((fd, hashlib.sha1()) for fd in fds)
+    offsets = dict.fromkeys(fds, 0)
+    elevator_hash_range(reader, fds, hashers, offsets, 20, layouts)
+    # One sweep up the disk, then the sweep starts over
+    assert reader.reads == [
+        (2, 0), (2, 10), (3, 0), (1, 0), (1, 10), (3, 10)]
+    assert offsets == dict.fromkeys(fds, 20)
+
+
+class RecordingReader(Reader):
+    def __init__(self, *args, **kwargs):
+        super(RecordingReader, self).__init__(*args, **kwargs)
+        self.reads = []
+
+    def _read(self, fd, cbuf, offset, size=None):
+        self.reads.append((fd, offset))
+        return super(RecordingReader, self)._read(fd, cbuf, offset, size)
+
+
+def test_partition_disk_order(tmpdir):
+    data = os.urandom(4096 + 100)
+    fds = open_samples(tmpdir, [data] * 3)
+    try:
+        reader = RecordingReader(4096)
+        # The files are laid out in reverse order on disk, except
+        # for the rest of the first file, which comes before the others
+        positions = {
+            fds[0]: lambda offset: 3000 if offset else 2000,
+            fds[1]: lambda offset: 1000 + offset,
+            fds[2]: lambda offset: offset,
+        }
+        layouts = dict((fd, FakeLayout(positions[fd])) for fd in fds)
+        classes = reader.partition(fds, layouts=layouts)
+        assert [sorted(cls) for cls in classes] == [sorted(fds)]
+        assert reader.reads == [
+            (fds[2], 0), (fds[1], 0), (fds[0], 0),
+            (fds[0], 4096), (fds[2], 4096), (fds[1], 4096),
+            (fds[0], 8192), (fds[2], 8192), (fds[1], 8192)]
+    finally:
+        for fd in fds:
+            os.close(fd)
+
+
+def test_stripe_index():
+    stripe_len = 64 * 1024
+
+    def stripes(profile, num_stripes, sub_stripes=0, count=8):
+        chunk = Chunk(
+            0, 1024 ** 3, tuple(xrange(num_stripes)),
+            btrfs_lib.BTRFS_BLOCK_GROUP_DATA | profile, stripe_len,
+            sub_stripes)
+        return [
+            stripe_index(chunk, i * stripe_len + 1) for i in xrange(count)]
+
+    assert stripes(0, 1) == [0] * 8
+    assert stripes(btrfs_lib.BTRFS_BLOCK_GROUP_RAID1, 2) == [0] * 8
+    assert stripes(btrfs_lib.BTRFS_BLOCK_GROUP_RAID0, 3) == [
+        0, 1, 2, 0, 1, 2, 0, 1]
+    # Pairs of mirrors, the first copy is read
+    assert stripes(btrfs_lib.BTRFS_BLOCK_GROUP_RAID10, 4, 2) == [
+        0, 2, 0, 2, 0, 2, 0, 2]
+    # The parity stripe rotates with every full stripe
+    assert stripes(btrfs_lib.BTRFS_BLOCK_GROUP_RAID5, 3) == [
+        0, 1, 1, 2, 2, 0, 0, 1]
+    assert stripes(btrfs_lib.BTRFS_BLOCK_GROUP_RAID6, 4) == [
+        0, 1, 1, 2, 2, 3, 3, 0]
+
+
 def teardown_module():
     if vol_fd is not None:
         os.close(vol_fd)
@@ -0,0 +1,243 @@
+# bedup - Btrfs deduplication
+# Copyright (C) 2012 Gabriel de Perthuis <g2p.code+bedup@gmail.com>
+#
+# This file is part of bedup.
+#
+# bedup is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# bedup is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with bedup.  If not, see <http://www.gnu.org/licenses/>.
+
+import signal
+import threading
+import time
+
+from .platform.time import monotonic_time
+
+
+# Rates are measured over windows of this many seconds
+RATE_WINDOW = 1.
+
+MIN_READ_RATE = 64 * 1024
+
+# Linux 4.20, with CONFIG_PSI
+PRESSURE_PATH = '/proc/pressure/%s'
+# How often pressure is sampled, and rechecked while paused
+PRESSURE_CHECK_INTERVAL = 1.
+PRESSURE_PAUSE_INTERVAL = 5.
+
+
+def read_pressure(resource):
+    """The share of time some tasks stalled on resource (io, memory),
+    as a percentage averaged over 10 seconds.
+
+    Returns None if the kernel doesn't report pressure.
+    """
+
+    try:
+        with open(PRESSURE_PATH % resource) as psi:
+            for line in psi:
+                fields = line.split()
+                if fields[0] != 'some':
+                    continue
+                for field in fields[1:]:
+                    key, val = field.split('=')
+                    if key == 'avg10':
+                        return float(val)
+    except (IOError, OSError):
+        return
+
+
+class PressureMonitor(object):
+    """Pauses callers while the system is under pressure.
+
+    thresholds maps resources (io, memory) to the avg10 stall
+    percentage above which wait blocks.  Resources the kernel doesn't
+    report are ignored.
+    """
+
+    def __init__(self, thresholds):
+        self._lock = threading.Lock()
+        self.thresholds = dict(
+            (resource, threshold)
+            for resource, threshold in thresholds.iteritems()
+            if threshold is not None
+            and read_pressure(resource) is not None)
+        self.unavailable = sorted(set(
+            resource for resource, threshold in thresholds.iteritems()
+            if threshold is not None) - set(self.thresholds))
+        self.paused_time = 0.
+        self.pauses = 0
+        self.paused = False
+        self._last_check = None
+
+    def _over(self):
+        for resource, threshold in self.thresholds.iteritems():
+            pressure = read_pressure(resource)
+            if pressure is not None and pressure > threshold:
+                return True
+        return False
+
+    def wait(self):
+        """Returns once pressure is below the thresholds.
+
+        Other threads calling wait block until the pause is over.
+        """
+
+        if not self.thresholds:
+            return
+        with self._lock:
+            now = monotonic_time()
+            if (
+                self._last_check is not None
+                and now - self._last_check < PRESSURE_CHECK_INTERVAL
+            ):
+                return
+            self._last_check = now
+            if not self._over():
+                return
+            self.paused = True
+            self.pauses += 1
+            try:
+                while True:
+                    time.sleep(PRESSURE_PAUSE_INTERVAL)
+                    if not self._over():
+                        break
+            finally:
+                self.paused = False
+                self._last_check = end = monotonic_time()
+                self.paused_time += end - now
+
+
+class ReadThrottle(object):
+    """Token buckets for read bandwidth and read calls per second.
+
+    Shared by every thread that reads.  wait blocks until a read is
+    allowed, and charge takes the bytes that were actually read; a read
+    can go over the limit, the next reads then wait for it.  Reads done
+    while holding files locked are only charged.
+    The buckets hold up to a second's worth of tokens.
+    A limit of None means unlimited; limits can be changed while
+    reads are going on.
+    With a PressureMonitor, pause waits while the system is under
+    pressure; it is called between groups of files and before reads,
+    never while files are locked.
+    """
+
+    def __init__(self, max_rate=None, max_iops=None, pressure=None):
+        # Reentrant for the signal handlers
+        self._lock = threading.RLock()
+        self.max_rate = max_rate
+        self.max_iops = max_iops
+        self._byte_tokens = max_rate or 0
+        self._op_tokens = max_iops or 0
+        self._last_refill = self._window_start = monotonic_time()
+        self._window_bytes = 0
+        self.rate = 0.
+        self.pressure = pressure
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.max_rate is not None:
+            self._byte_tokens = min(
+                self.max_rate, self._byte_tokens + elapsed * self.max_rate)
+        if self.max_iops is not None:
+            self._op_tokens = min(
+                self.max_iops, self._op_tokens + elapsed * self.max_iops)
+
+    def _measure(self, now, size):
+        self._window_bytes += size
+        elapsed = now - self._window_start
+        if elapsed >= RATE_WINDOW:
+            self.rate = self._window_bytes / elapsed
+            self._window_start = now
+            self._window_bytes = 0
+
+    def _delay(self):
+        # How long until the buckets are out of debt
+        delay = 0.
+        if self.max_rate is not None and self._byte_tokens < 0:
+            delay = -self._byte_tokens / float(self.max_rate)
+        if self.max_iops is not None and self._op_tokens < 0:
+            delay = max(delay, -self._op_tokens / float(self.max_iops))
+        return delay
+
+    def wait(self):
+        """Waits until a read call is allowed."""
+
+        while True:
+            with self._lock:
+                self._refill(monotonic_time())
+                delay = self._delay()
+            if not delay:
+                return
+            # The limits may change while we sleep
+            time.sleep(delay)
+
+    def charge(self, size):
+        """Takes a read call of size bytes from the buckets."""
+
+        with self._lock:
+            now = monotonic_time()
+            self._refill(now)
+            self._measure(now, size)
+            if self.max_rate is not None:
+                self._byte_tokens -= size
+            if self.max_iops is not None:
+                self._op_tokens -= 1
+
+    def pause(self):
+        """Waits while the system is under pressure."""
+
+        if self.pressure is not None:
+            self.pressure.wait()
+
+    def scale(self, factor):
+        """Multiplies the limits by factor.
+
+        Scaling down without a bandwidth limit sets one,
+        from the rate achieved so far.
+        """
+
+        with self._lock:
+            self._refill(monotonic_time())
+            if self.max_rate is not None:
+                self.max_rate = max(
+                    MIN_READ_RATE, int(self.max_rate * factor))
+            elif factor < 1 and self.rate:
+                self.max_rate = max(MIN_READ_RATE, int(self.rate * factor))
+                self._byte_tokens = 0
+            if self.max_iops is not None:
+                self.max_iops = max(1, int(self.max_iops * factor))
+
+    def describe(self):
+        rv = 'read %.1fMiB/s' % (self.rate / 1024 ** 2)
+        if self.max_rate is not None:
+            rv += ' (max %.1fMiB/s)' % (self.max_rate / 1024. ** 2)
+        if self.max_iops is not None:
+            rv += ' (max %d reads/s)' % self.max_iops
+        if self.pressure is not None and self.pressure.paused:
+            rv += ' paused (pressure)'
+        return rv
+
+
+def install_signal_handlers(throttle):
+    """SIGUSR1 halves the read limits, SIGUSR2 doubles them."""
+
+    def slower(signum, frame):
+        throttle.scale(.5)
+
+    def faster(signum, frame):
+        throttle.scale(2)
+
+    signal.signal(signal.SIGUSR1, slower)
+    signal.signal(signal.SIGUSR2, faster)
@@ -17,13 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with bedup.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
 import errno
-import fcntl
 import gc
 import hashlib
 import os
+import Queue
 import resource
-import stat
 import sys
 import threading
 
@@ -32,31 +32,75 @@ from compat import fsdecode
 from contextlib import closing
 from contextlib2 import ExitStack
 from itertools import groupby
-from sqlalchemy.sql import and_, select, func, literal_column
+from multiprocessing.pool import ThreadPool
+from sqlalchemy.sql import (
+    and_, or_, bindparam, case, select, func, literal_column)
 
 from .platform.btrfs import (
-    get_root_generation, clone_data, defragment)
+    get_root_generation, clone_data, defragment, extent_same, file_extents,
+    has_extent_same, lib as btrfs_lib,
+    SearchBatch, TreeSearch, DEFAULT_TREE_SEARCH_BUF_SIZE,
+    EXTENT_SEARCH_BUF_SIZE, U64_MAX)
+from .platform.fiemap import fiemap, same_extents, lib as fiemap_lib
+from .platform.futimens import change_times_ns
+from .platform.ioprio import gettid, set_idle_priority
 from .platform.openat import fopenat, fopenat_rw
+from .platform.time import monotonic_time
 
 from .datetime import system_now
-from .dedup import ImmutableFDs, cmp_files
-from .hashing import mini_hash_from_file, fiemap_hash_from_file
+from .dedup import ImmutableFDs, ProcFdIndex, cmp_files
+from .devices import DeviceMap, DeviceQueues
+from .hashing import (
+    default_sampler, extent_tree_hash, CsumFingerprinter,
+    SAMPLE_HOLE, SAMPLE_ZERO)
 from .model import (
-    Inode, get_or_create, DedupEvent, DedupEventInode)
+    BlockDigest, BtrfsFilesystem, Inode, Volume, DedupEvent, DedupEventInode,
+    get_or_create)
+from .reading import (
+    Reader, DEFAULT_READ_BUFFER_SIZE, DEFAULT_READ_STRATEGY)
+from .termupdates import format_duration
 
 
-BUFSIZE = 8192
-
 WINDOW_SIZE = 200
 
+# Scanned inodes are written this many rows at a time
+UPSERT_BATCH_SIZE = 4096
+
+# Seconds between commits of an unfinished scan
+SCAN_CHECKPOINT_INTERVAL = 30
+
+# The prefix lengths of progressive_hash
+HASH_TIERS = (1024 ** 2, 16 * 1024 ** 2, 256 * 1024 ** 2, None)
+
+# Groups files that Reader.is_zero verified; not a real digest
+ZERO_DIGEST = 'zero'
+
+# Groups this small are compared directly (Reader.partition),
+# unless some digests are already known.
+MAX_LOCKSTEP_FILES = 4
+
 
 def reset_vol(sess, vol):
     # Forgets Inodes, not logging. Make that configurable?
     sess.query(Inode).filter_by(vol=vol).delete()
+    sess.query(BlockDigest).filter_by(vol=vol).delete()
     vol.last_tracked_generation = 0
+    vol.impl.clear_scan_cursor()
     sess.commit()
 
 
+def forget_block_digests(sess, vol_id, ino):
+    sess.query(BlockDigest).filter_by(vol_id=vol_id, ino=ino).delete(
+        synchronize_session=False)
+
+
+def forget_inode(sess, inode):
+    """Stops tracking an inode that was removed or replaced."""
+
+    forget_block_digests(sess, inode.vol_id, inode.ino)
+    sess.delete(inode)
+
+
 def fake_updates(sess, max_events):
     faked = 0
     for de in sess.query(DedupEvent).limit(max_events):
@@ -74,106 +118,385 @@ def fake_updates(sess, max_events):
     return faked
 
 
-def track_updated_files(sess, vol, tt):
-    from .platform.btrfs import ffi, u64_max
+class VolumeScan(object):
+    """Finds the files of a volume that changed since it was last tracked.
+
+    Database state is only read from the constructor and written from
+    finish, so that iter_rows can run in a worker thread.
+    """
+
+    def __init__(
+        self, sess, vol, search_buf_size=DEFAULT_TREE_SEARCH_BUF_SIZE,
+        scan_extents=False,
+    ):
+        self.vol = vol
+        # New volumes may still be pending, we need their id below
+        sess.flush()
+        self.vol_id = vol.impl.id
+        self.size_cutoff = vol.size_cutoff
+
+        # Resume an interrupted scan, keeping its target generation
+        min_key = vol.impl.scan_cursor
+        if min_key is not None:
+            self.resumed = True
+            self.top_generation = vol.impl.scan_top_generation
+        else:
+            self.resumed = False
+            min_key = (0, btrfs_lib.BTRFS_INODE_ITEM_KEY, 0)
+            self.top_generation = get_root_generation(vol.fd)
+        if (vol.last_tracked_size_cutoff is not None
+            and vol.last_tracked_size_cutoff <= vol.size_cutoff):
+            self.min_generation = vol.last_tracked_generation + 1
+        else:
+            self.min_generation = 0
+
+        # Inodes are selected by their transid, which any change to the
+        # inode bumps, rather than their creation generation, which
+        # misses files rewritten in place.  upsert_inodes tells apart
+        # changes that didn't touch the data.
+        if vol.last_tracked_size_cutoff:
+            self.old_size_cutoff = vol.last_tracked_size_cutoff
+            self.old_min_generation = vol.last_tracked_generation + 1
+        else:
+            self.old_size_cutoff = self.old_min_generation = 0
+
+        # min_ criteria are modified by the kernel during tree traversal;
+        # they are used as an iterator on tuple order,
+        # not an intersection of min ranges.
+        # The search will still return the INODE_REF, XATTR and EXTENT_DATA
+        # items that come after each inode item, but when a buffer ends in
+        # the middle of an objectid we don't go back for the rest of it.
+        self.search = TreeSearch(
+            vol.fd, tree_id=0, min_transid=self.min_generation,
+            min_key=min_key,
+            max_key=(U64_MAX, btrfs_lib.BTRFS_INODE_ITEM_KEY, U64_MAX),
+            buf_size=search_buf_size, skip_objectid_tail=True)
+
+        # Reads the extent items of every retained inode,
+        # so that dedup knows which files share their extents
+        # without opening them.
+        if scan_extents:
+            self.extent_search = TreeSearch(
+                vol.fd, tree_id=0, buf_size=EXTENT_SEARCH_BUF_SIZE)
+        else:
+            self.extent_search = None
+
+        self.inode_items = self.retained = 0
+        self.elapsed = 0.
+
+    def start(self, tt):
+        """Announces the scan. Returns False if there is nothing to scan.
+        """
+
+        if self.min_generation > self.top_generation:
+            tt.notify(
+                'Not scanning %s, generation is still %d'
+                % (self.vol, self.top_generation))
+            return False
+        tt.notify(
+            '%s volume %s generations from %d to %d, '
+            'with size cutoff %d'
+            % ('Resuming scan of' if self.resumed else 'Scanning',
+               self.vol, self.min_generation, self.top_generation,
+               self.size_cutoff))
+        if self.resumed:
+            tt.notify('Resuming at objectid %d' % self.search.min_key[0])
+        return True
+
+    def iter_rows(self):
+        """Yields upsert_inodes rows for each search buffer.
+
+        Each list of rows comes with the search key that follows them,
+        which is None once the search is complete.
+        """
+
+        start_time = monotonic_time()
+        batch = SearchBatch()
+        for sbuf in self.search.buffers():
+            sbuf.decode(batch)
+            selected, nr_inode_items = batch.select_files(
+                self.size_cutoff, self.min_generation,
+                self.old_size_cutoff, self.old_min_generation)
+            self.inode_items += nr_inode_items
+            self.retained += len(selected)
+            rows = [
+                dict(
+                    b_vol_id=self.vol_id, b_ino=batch.objectid[i],
+                    b_size=batch.inode_size[i],
+                    b_generation=batch.inode_generation[i],
+                    b_transid=batch.inode_transid[i],
+                    b_mtime=batch.inode_mtime[i])
+                for i in selected]
+            if self.extent_search is not None:
+                for row in rows:
+                    row['b_fiemap_hash'] = extent_tree_hash(file_extents(
+                        self.extent_search, row['b_ino']))
+            yield rows, self.search.next_key(sbuf.last_key)
+        self.elapsed = monotonic_time() - start_time
+
+    def checkpoint(self, sess, rows, resume_key):
+        """Writes rows and records that the scan can resume at resume_key.
+
+        The caller commits.
+        """
+
+        upsert_inodes(sess, rows)
+        if resume_key is not None:
+            self.vol.impl.save_scan_cursor(self.top_generation, resume_key)
+
+    def finish(self, sess, tt):
+        """Records the scan as complete; rows must have been written.
+        """
 
-    top_generation = get_root_generation(vol.fd)
-    if (vol.last_tracked_size_cutoff is not None
-        and vol.last_tracked_size_cutoff <= vol.size_cutoff):
-        min_generation = vol.last_tracked_generation + 1
-    else:
-        min_generation = 0
-    if min_generation > top_generation:
         tt.notify(
-            'Not scanning %s, generation is still %d'
-            % (vol, top_generation))
+            'Scanned %s: %s (%d inode items), retained %d inodes in %s '
+            '(%d inodes/s)'
+            % (self.vol, self.search.describe_stats(), self.inode_items,
+               self.retained, format_duration(self.elapsed),
+               self.retained / max(self.elapsed, 1e-3)))
+        if self.extent_search is not None:
+            tt.notify(
+                'Read extents: %s' % self.extent_search.describe_stats())
+        self.vol.last_tracked_generation = self.top_generation
+        self.vol.last_tracked_size_cutoff = self.size_cutoff
+        self.vol.impl.clear_scan_cursor()
+        sess.commit()
+
+
+def track_updated_files(
+    sess, vol, tt, search_buf_size=DEFAULT_TREE_SEARCH_BUF_SIZE,
+    scan_extents=False,
+):
+    scan = VolumeScan(sess, vol, search_buf_size, scan_extents)
+    if not scan.start(tt):
         sess.commit()
         return
-    tt.notify(
-        'Scanning volume %s generations from %d to %d, with size cutoff %d'
-        % (vol, min_generation, top_generation, vol.size_cutoff))
     tt.format(
-        '{elapsed} Scanned {scanned} retained {retained:counter}')
-    scanned = 0
-
-    args = ffi.new('struct btrfs_ioctl_search_args *')
-    args_buffer = ffi.buffer(args)
-    sk = args.key
-    lib = ffi.verifier.load_library()
-
-    # Not a valid objectid that I know.
-    # But find-new uses that and it seems to work.
-    sk.tree_id = 0
-
-    # Because we don't have min_objectid = max_objectid,
-    # a min_type filter would be ineffective.
-    # min_ criteria are modified by the kernel during tree traversal;
-    # they are used as an iterator on tuple order,
-    # not an intersection of min ranges.
-    sk.min_transid = min_generation
-
-    sk.max_objectid = u64_max
-    sk.max_offset = u64_max
-    sk.max_transid = u64_max
-    sk.max_type = lib.BTRFS_INODE_ITEM_KEY
+        '{elapsed} Scanned {scanned} retained {retained}')
+    rows = []
+    last_checkpoint = monotonic_time()
+    for chunk, resume_key in scan.iter_rows():
+        rows.extend(chunk)
+        tt.update(scanned=scan.search.item_count, retained=scan.retained)
+        if monotonic_time() - last_checkpoint >= SCAN_CHECKPOINT_INTERVAL:
+            scan.checkpoint(sess, rows, resume_key)
+            sess.commit()
+            rows = []
+            last_checkpoint = monotonic_time()
+        elif len(rows) >= UPSERT_BATCH_SIZE:
+            upsert_inodes(sess, rows)
+            rows = []
+    upsert_inodes(sess, rows)
+    tt.format(None)
+    scan.finish(sess, tt)
 
-    while True:
-        sk.nr_items = 4096
 
+def _scan_worker(todo, results):
+    while True:
+        try:
+            scan = todo.get_nowait()
+        except Queue.Empty:
+            return
         try:
-            fcntl.ioctl(
-                vol.fd, lib.BTRFS_IOC_TREE_SEARCH, args_buffer)
-        except IOError:
-            raise
+            for chunk, resume_key in scan.iter_rows():
+                results.put((scan, (chunk, resume_key), None))
+        except Exception as exn:
+            results.put((scan, None, exn))
+            return
+        results.put((scan, None, None))
+
+
+def track_updated_vols(
+    sess, vols, tt, jobs, search_buf_size=DEFAULT_TREE_SEARCH_BUF_SIZE,
+    scan_extents=False,
+):
+    """Scans several volumes at once.
+
+    Tree searches run in up to jobs worker threads; this thread owns the
+    session and writes everything they find.
+    A volume's tracked generation is only updated in the transaction
+    that commits the last of its inodes.
+    """
+
+    todo = Queue.Queue()
+    scans = []
+    seen = set()
+    for vol in vols:
+        # The same volume may be given more than once
+        if vol in seen:
+            continue
+        seen.add(vol)
+        scan = VolumeScan(sess, vol, search_buf_size, scan_extents)
+        if scan.start(tt):
+            todo.put(scan)
+            scans.append(scan)
+    sess.commit()
+    if not scans:
+        return
 
-        if sk.nr_items == 0:
-            break
+    # Bounded, so that a slow writer applies backpressure
+    results = Queue.Queue(maxsize=4 * jobs)
+    for i in xrange(min(jobs, len(scans))):
+        worker = threading.Thread(
+            target=_scan_worker, args=(todo, results),
+            name='scanner-%d' % i)
+        worker.daemon = True
+        worker.start()
 
-        offset = 0
-        for item_id in xrange(sk.nr_items):
-            sh = ffi.cast(
-                'struct btrfs_ioctl_search_header *', args.buf + offset)
-            offset += ffi.sizeof('struct btrfs_ioctl_search_header') + sh.len
-
-            # We can't prevent the search from grabbing irrelevant types
-            if sh.type == lib.BTRFS_INODE_ITEM_KEY:
-                item = ffi.cast(
-                    'struct btrfs_inode_item *', sh + 1)
-                inode_gen = lib.btrfs_stack_inode_generation(item)
-                size = lib.btrfs_stack_inode_size(item)
-                mode = lib.btrfs_stack_inode_mode(item)
-                if size < vol.size_cutoff:
-                    continue
-                # XXX Should I use inner or outer gen in these checks?
-                # Inner gen seems to miss updates (due to delalloc?),
-                # whereas outer gen has too many spurious updates.
-                if (vol.last_tracked_size_cutoff
-                    and size >= vol.last_tracked_size_cutoff):
-                    if inode_gen <= vol.last_tracked_generation:
-                        continue
-                else:
-                    if inode_gen < min_generation:
-                        continue
-                if not stat.S_ISREG(mode):
-                    continue
-                ino = sh.objectid
-                inode, inode_created = get_or_create(
-                    sess, Inode, vol=vol.impl, ino=ino)
-                inode.size = size
-                inode.has_updates = True
-                tt.update(retained=True)
-        scanned += sk.nr_items
-        tt.update(scanned=scanned)
-
-        sk.min_objectid = sh.objectid
-        sk.min_type = sh.type
-        sk.min_offset = sh.offset
-
-        sk.min_offset += 1
+    tt.format(
+        '{elapsed} Scanned {scanned} retained {retained} '
+        'volumes {vols:counter}/{vols:total}')
+    tt.set_total(vols=len(scans))
+    rows = defaultdict(list)
+    resume_keys = {}
+    pending = len(scans)
+    last_checkpoint = monotonic_time()
+    while pending:
+        scan, item, exn = results.get()
+        if exn is not None:
+            raise exn
+        if item is not None:
+            chunk, resume_keys[scan] = item
+            rows[scan].extend(chunk)
+            if len(rows[scan]) >= UPSERT_BATCH_SIZE:
+                upsert_inodes(sess, rows.pop(scan))
+        else:
+            upsert_inodes(sess, rows.pop(scan, None))
+            resume_keys.pop(scan, None)
+            scan.finish(sess, tt)
+            tt.update(vols=None)
+            pending -= 1
+        if monotonic_time() - last_checkpoint >= SCAN_CHECKPOINT_INTERVAL:
+            for scan, resume_key in resume_keys.iteritems():
+                scan.checkpoint(sess, rows.pop(scan, None), resume_key)
+            sess.commit()
+            last_checkpoint = monotonic_time()
+        tt.update(
+            scanned=sum(scan.search.item_count for scan in scans),
+            retained=sum(scan.retained for scan in scans))
     tt.format(None)
-    vol.last_tracked_generation = top_generation
-    vol.last_tracked_size_cutoff = vol.size_cutoff
-    sess.commit()
+
+
+def upsert_inodes(sess, rows):
+    """Records scanned inodes as having updates, without going through the ORM.
+
+    rows are dicts with b_vol_id, b_ino, b_size, b_generation, b_transid
+    and b_mtime keys, and b_fiemap_hash when scanning extents.
+    Known inodes get updated, the others are inserted.
+
+    An inode whose generation, size and mtime haven't changed only had
+    its metadata changed (permissions, xattrs, links, or our own
+    immutable flag) since we last saw it; its has_updates flag and
+    content hashes are left alone.
+    Otherwise (or when the inode number was reused) the hashes are
+    invalidated.  The extent hash is kept only if the transid
+    didn't change either, since defragmenting doesn't change mtime.
+    """
+
+    if not rows:
+        return
+    inode = Inode.__table__
+    unchanged = and_(
+        inode.c.generation == bindparam('b_generation'),
+        inode.c.transid == bindparam('b_transid'))
+    same_data = and_(
+        inode.c.generation == bindparam('b_generation'),
+        inode.c.size == bindparam('b_size'),
+        inode.c.mtime == bindparam('b_mtime'))
+
+    def carry_transid(col):
+        # Stays valid across a metadata-only change
+        return case(
+            [(and_(same_data, col == inode.c.transid),
+              bindparam('b_transid'))],
+            else_=col)
+
+    inserted = dict(
+        vol_id=bindparam('b_vol_id'), ino=bindparam('b_ino'),
+        size=bindparam('b_size'), generation=bindparam('b_generation'),
+        transid=bindparam('b_transid'), mtime=bindparam('b_mtime'),
+        has_updates=True)
+    if 'b_fiemap_hash' in rows[0]:
+        # Read along with the inode, never stale
+        fiemap_hash = inserted['fiemap_hash'] = bindparam('b_fiemap_hash')
+    else:
+        fiemap_hash = case([(unchanged, inode.c.fiemap_hash)], else_=None)
+    # SQLite has no portable upsert; this takes two executemany calls.
+    # SET expressions all see the values from before the update.
+    sess.execute(
+        inode.update().where(and_(
+            inode.c.vol_id == bindparam('b_vol_id'),
+            inode.c.ino == bindparam('b_ino'),
+        )).values(
+            size=bindparam('b_size'),
+            generation=bindparam('b_generation'),
+            transid=bindparam('b_transid'),
+            mtime=bindparam('b_mtime'),
+            has_updates=case(
+                [(same_data, inode.c.has_updates)], else_=True),
+            mini_hash=case([(same_data, inode.c.mini_hash)], else_=None),
+            block_transid=carry_transid(inode.c.block_transid),
+            fiemap_hash=fiemap_hash),
+        rows)
+    sess.execute(
+        inode.insert().prefix_with('OR IGNORE').values(**inserted), rows)
+
+
+def _track_inodes_orm(sess, vol, rows):
+    # How scans recorded inodes before upsert_inodes
+    for row in rows:
+        inode, inode_created = get_or_create(
+            sess, Inode, vol=vol, ino=row['b_ino'])
+        inode.size = row['b_size']
+        inode.generation = row['b_generation']
+        inode.transid = row['b_transid']
+        inode.mtime = row['b_mtime']
+        inode.has_updates = True
+
+
+def _track_inodes_batched(sess, vol, rows):
+    for i in xrange(0, len(rows), UPSERT_BATCH_SIZE):
+        upsert_inodes(sess, rows[i:i + UPSERT_BATCH_SIZE])
+
+
+def bench_upserts(make_session, count, repeat=3):
+    """Times recording scanned inodes through the ORM and with upserts.
+
+    make_session returns a session on a new, empty database.
+    Each run records count synthetic inodes as a first scan would,
+    then again as a rescan that finds them all modified.
+    Yields (description, seconds, inodes) for the best of repeat runs.
+    """
+
+    def scan_rows(vol_id, transid):
+        return [
+            dict(
+                b_vol_id=vol_id, b_ino=ino, b_size=ino * 4096,
+                b_generation=5, b_transid=transid, b_mtime=transid * 10 ** 9)
+            for ino in xrange(257, 257 + count)]
+
+    for desc, track in [
+        ('get_or_create', _track_inodes_orm),
+        ('upsert_inodes', _track_inodes_batched),
+    ]:
+        best = {}
+        for i in xrange(repeat):
+            sess = make_session()
+            fs = BtrfsFilesystem(uuid='00000000-0000-0000-0000-000000000000')
+            vol = Volume(fs=fs, root_id=5, size_cutoff=0)
+            sess.add(vol)
+            sess.commit()
+            for scan, transid in [('scan', 10), ('rescan', 11)]:
+                rows = scan_rows(vol.id, transid)
+                start = monotonic_time()
+                track(sess, vol, rows)
+                sess.commit()
+                elapsed = monotonic_time() - start
+                if scan not in best or elapsed < best[scan]:
+                    best[scan] = elapsed
+            sess.close()
+        for scan in ['scan', 'rescan']:
+            yield '%s, %s' % (scan, desc), best[scan], count
 
 
 class Checkpointer(threading.Thread):
@@ -210,13 +533,15 @@ Commonality1 = namedtuple('Commonality1', 'size inode_count inodes')
 
 class WindowedQuery(object):
     def __init__(
-        self, sess, unfiltered, filt_crit, tt, window_size=WINDOW_SIZE
+        self, sess, unfiltered, filt_crit, tt, window_size=WINDOW_SIZE,
+        sampler=default_sampler,
     ):
         self.sess = sess
         self.unfiltered = unfiltered
         self.filt_crit = filt_crit
         self.tt = tt
         self.window_size = window_size
+        self.sampler = sampler
 
         self.skipped = []
 
@@ -284,11 +609,16 @@ class WindowedQuery(object):
             # If we wanted to be subtle we'd use limits here as well
             inodes = self.sess.query(Inode).select_from(self.filtered_s).join(
                 window_select, window_select.c.size == Inode.size
-            ).order_by(-Inode.size, Inode.ino)
-            inodes_by_size = groupby(inodes, lambda inode: inode.size)
-            for size, inodes in inodes_by_size:
-                inodes = list(inodes)
-                yield Commonality1(size, len(inodes), inodes)
+            )
+            inodes = self.filter_mini_hash_groups(
+                inodes, window_start, window_end
+            ).order_by(-Inode.size, Inode.mini_hash, Inode.ino)
+            inodes_by_size = dict(
+                (size, list(inodes))
+                for size, inodes in groupby(inodes, lambda inode: inode.size))
+            for row in li:
+                inodes = inodes_by_size.get(row.size, [])
+                yield Commonality1(row.size, len(inodes), inodes)
             self.clear_updates(window_start, window_end)
             checkpointer.please_checkpoint()
             window_start = window_end - 1
@@ -299,6 +629,45 @@ class WindowedQuery(object):
         # will be durable.
         self.sess.execute('PRAGMA synchronous=FULL;')
 
+    def filter_mini_hash_groups(self, inodes, window_start, window_end):
+        # Leaves out the inodes whose mini hash is current and unique
+        # within their size, or shared only with inodes without updates.
+        # Sizes with mini hashes still to be computed are loaded whole.
+        filtered = self.filtered_s
+        low, high = self.sampler.current_range()
+        in_window = and_(
+            filtered.c.size <= window_start, filtered.c.size >= window_end)
+        is_current = and_(
+            filtered.c.mini_hash >= low, filtered.c.mini_hash <= high)
+        pending = select([
+            filtered.c.size,
+        ]).where(and_(
+            in_window,
+            or_(filtered.c.mini_hash == None,
+                filtered.c.mini_hash < low, filtered.c.mini_hash > high),
+        )).group_by(
+            filtered.c.size,
+        ).alias('pending')
+        mh_groups = select([
+            filtered.c.size, filtered.c.mini_hash, filtered.c.sample_class,
+        ]).where(and_(
+            in_window, is_current,
+        )).group_by(
+            filtered.c.size, filtered.c.mini_hash, filtered.c.sample_class,
+        ).having(and_(
+            func.count() > 1,
+            func.max(filtered.c.has_updates) > 0,
+        )).alias('mh_groups')
+        return inodes.outerjoin(
+            pending, pending.c.size == Inode.size
+        ).outerjoin(
+            mh_groups, and_(
+                mh_groups.c.size == Inode.size,
+                mh_groups.c.mini_hash == Inode.mini_hash,
+                mh_groups.c.sample_class == Inode.sample_class)
+        ).filter(or_(
+            pending.c.size != None, mh_groups.c.size != None))
+
     def clear_updates(self, window_start, window_end):
         # Can't call update directly on FilteredInode because it is aliased.
         # Can't use a <= b <= c in one term with SQLa.
@@ -320,10 +689,137 @@ class WindowedQuery(object):
         return self.clear_updates(self.upper_bound, 0)
 
 
-def dedup_tracked(sess, volset, tt):
+class ExtentLayout(object):
+    """Where the data of a file is on disk, according to FIEMAP."""
+
+    def __init__(self, fd):
+        self.extents = list(fiemap(fd))
+        self._starts = [extent.logical for extent in self.extents]
+
+    def physical(self, offset):
+        # Holes and data without a location yet sort first
+        i = bisect.bisect_right(self._starts, offset) - 1
+        if i < 0:
+            return 0
+        extent = self.extents[i]
+        if offset >= extent.logical + extent.length:
+            return 0
+        return extent.physical + offset - extent.logical
+
+
+def placed_extents(fd):
+    """The extents of a file, without the flags that change
+    when other files share them."""
+
+    flags_mask = ~fiemap_lib.FIEMAP_EXTENT_SHARED
+    return tuple(
+        extent._replace(flags=extent.flags & flags_mask)
+        for extent in fiemap(fd))
+
+
+def elevator_hash_range(reader, fds, hashers, offsets, end, layouts):
+    """Feeds each file to its hasher from its offset up to end
+    (None for the end of the file), in elevator order.
+
+    Files are read one chunk at a time, each in logical order,
+    picking the file whose next chunk is physically closest ahead
+    of the last one; past the last chunk, the sweep starts over.
+    Updates offsets.
+    """
+
+    pending = set(fds)
+    position = 0
+    while pending:
+        heads = sorted(
+            (layouts[fd].physical(offsets[fd]), fd) for fd in pending)
+        ahead = [head for head in heads if head[0] >= position]
+        physical, fd = (ahead or heads)[0]
+        chunk_end = offsets[fd] + reader.buf_size
+        if end is not None:
+            chunk_end = min(chunk_end, end)
+        count = reader.hash_range(fd, hashers[fd], offsets[fd], chunk_end)
+        offsets[fd] += count
+        position = physical + count
+        if offsets[fd] < chunk_end or offsets[fd] == end:
+            pending.discard(fd)
+
+
+def progressive_hash(
+    reader, fds, size, hash_map=map, keep_singletons=False, elevator=False
+):
+    """Hashes same-size files, reading as little as possible.
+
+    Files are hashed in tiers, up to each HASH_TIERS offset.
+    After each tier, files whose prefix digest is unique are dropped,
+    unless keep_singletons is set (they may match a digest we already
+    have).
+    With elevator, reads are done from this thread in elevator order
+    (see elevator_hash_range) rather than one file after the other.
+    Returns the full digests of the remaining files, keyed by fd.
+    """
+
+    if len(fds) < 2 and not keep_singletons:
+        return {}
+    hashers = dict((fd, hashlib.sha1()) for fd in fds)
+    offsets = dict.fromkeys(fds, 0)
+    groups = [list(fds)]
+    if elevator:
+        layouts = dict((fd, ExtentLayout(fd)) for fd in fds)
+
+    for end in HASH_TIERS:
+        def advance(fd):
+            offsets[fd] += reader.hash_range(
+                fd, hashers[fd], offsets[fd], end)
+            # hashlib objects can keep going after a digest
+            return hashers[fd].hexdigest()
+
+        active = [fd for group in groups for fd in group]
+        if elevator:
+            elevator_hash_range(
+                reader, active, hashers, offsets, end, layouts)
+            digests = dict((fd, hashers[fd].hexdigest()) for fd in active)
+        else:
+            digests = dict(zip(active, hash_map(advance, active)))
+        if end is None or end >= size:
+            break
+
+        split_groups = []
+        for group in groups:
+            by_prefix = defaultdict(list)
+            for fd in group:
+                by_prefix[digests[fd]].append(fd)
+            for fds1 in by_prefix.itervalues():
+                if len(fds1) > 1 or keep_singletons:
+                    split_groups.append(fds1)
+        groups = split_groups
+        if not groups:
+            return {}
+    return digests
+
+
+def _hash_worker_init():
+    set_idle_priority(gettid())
+
+
+def dedup_tracked(
+    sess, volset, tt, hash_threads=1,
+    read_buffer_size=DEFAULT_READ_BUFFER_SIZE, sampler=default_sampler,
+    backend='clone', csum_fingerprints=False,
+    read_strategy=DEFAULT_READ_STRATEGY, throttle=None, read_order='inode',
+    per_device_reads=False, proc_scan_interval=0,
+):
     fs = volset[0].fs
     vol_ids = [vol.impl.id for vol in volset]
     assert all(vol.fs == fs for vol in volset)
+    # The elevator reads from this thread, bypassing the device queues
+    assert not (per_device_reads and read_order == 'physical')
+
+    if backend == 'extent-same' and not has_extent_same(volset[0].fd):
+        tt.notify(
+            'The kernel doesn\'t support extent-same (Linux 3.12), '
+            'cloning instead')
+        backend = 'clone'
+    use_extent_same = backend == 'extent-same'
 
     # 3 for stdio, 3 for sqlite (wal mode), 1 that somehow doesn't
     # get closed, 1 per volume.
@@ -331,23 +827,56 @@ def dedup_tracked(sess, volset, tt):
 
     inode = Inode.__table__
     inode_filt = inode.c.vol_id.in_(vol_ids)
-    query = WindowedQuery(sess, inode, inode_filt, tt)
+    query = WindowedQuery(sess, inode, inode_filt, tt, sampler=sampler)
     le = len(query)
 
     if le:
         tt.format(
             '{elapsed} Size group {comm1:counter}/{comm1:total} '
             'sampled {mhash:counter} hashed {fhash:counter} '
-            'freed {space_gain:size}')
+            'freed {space_gain:size} {read_rate}')
         tt.set_total(comm1=le)
-        dedup_tracked1(sess, tt, ofile_reserved, query, fs)
+        reader = Reader(read_buffer_size, read_strategy, throttle)
+        proc_index = ProcFdIndex(proc_scan_interval)
+        if csum_fingerprints:
+            fingerprinter = CsumFingerprinter(volset[0].fd)
+        else:
+            fingerprinter = None
+        if per_device_reads:
+            device_map = DeviceMap(volset[0].fd)
+            tt.notify(
+                'Reading from %d devices concurrently'
+                % len(device_map.devids))
+            dedup_tracked1(
+                sess, tt, ofile_reserved, query, fs, reader, sampler,
+                use_extent_same, fingerprinter,
+                elevator=read_order == 'physical', proc_index=proc_index,
+                device_queues=DeviceQueues(device_map))
+        elif hash_threads > 1:
+            with closing(ThreadPool(
+                hash_threads, initializer=_hash_worker_init
+            )) as pool:
+                dedup_tracked1(
+                    sess, tt, ofile_reserved, query, fs, reader, sampler,
+                    use_extent_same, fingerprinter,
+                    elevator=read_order == 'physical', proc_index=proc_index,
+                    hash_map=pool.map)
+        else:
+            dedup_tracked1(
+                sess, tt, ofile_reserved, query, fs, reader, sampler,
+                use_extent_same, fingerprinter,
+                elevator=read_order == 'physical', proc_index=proc_index)
     else:
         query.clear_all_updates()
     sess.commit()
     tt.format(None)
 
 
-def dedup_tracked1(sess, tt, ofile_reserved, query, fs):
+def dedup_tracked1(
+    sess, tt, ofile_reserved, query, fs, reader, sampler, use_extent_same,
+    fingerprinter=None, elevator=False, proc_index=None, hash_map=map,
+    device_queues=None
+):
     space_gain = 0
     ofile_soft, ofile_hard = resource.getrlimit(resource.RLIMIT_OFILE)
 
@@ -357,54 +886,78 @@ def dedup_tracked1(sess, tt, ofile_reserved, query, fs):
     for comm1 in query:
         size = comm1.size
         tt.update(comm1=comm1)
+        if reader.throttle is not None:
+            tt.update(read_rate=reader.throttle.describe())
+            reader.throttle.pause()
+        # Zero and hole samples have the same mini hash
         by_mh = defaultdict(list)
         for inode in comm1.inodes:
+            if inode.has_mini_hash(sampler):
+                by_mh[inode.mini_hash, inode.sample_class].append(inode)
+                continue
+
             # XXX Need to cope with deleted inodes.
             # We cannot find them in the search-new pass, not without doing
             # some tracking of directory modifications to poke updated
             # directories to find removed elements.
 
-            # rehash everytime for now
-            # I don't know enough about how inode transaction numbers are
-            # updated (as opposed to extent updates) to be able to actually
-            # cache the result
             try:
                 pathb = inode.vol.live.lookup_one_path(inode)
             except IOError as e:
                 if e.errno != errno.ENOENT:
                     raise
                 # We have a stale record for a removed inode
-                # XXX If an inode number is reused and the second instance
-                # is below the size cutoff, we won't update the .size
-                # attribute and we won't get an IOError to notify us
-                # either.  Inode reuse does happen (with and without
-                # inode_cache), so this branch isn't enough to rid us of
-                # all stale entries.  We can also get into trouble with
-                # regular file inodes being replaced by some other kind of
-                # inode.
-                sess.delete(inode)
+                forget_inode(sess, inode)
                 continue
             with closing(fopenat(inode.vol.live.fd, pathb)) as rfile:
-                by_mh[mini_hash_from_file(inode, rfile)].append(inode)
+                # The inode number was reused, and the scan didn't replace
+                # our record (the new inode may be below the size cutoff).
+                # The generation check doesn't cover records from before
+                # we tracked generations.
+                if inode.is_reused_by(rfile):
+                    forget_inode(sess, inode)
+                    continue
+                inode.mini_hash_from_file(rfile, sampler)
+                by_mh[inode.mini_hash, inode.sample_class].append(inode)
                 tt.update(mhash=None)
 
-        for inodes in by_mh.itervalues():
+        for (mini_hash, sample_class), inodes in by_mh.iteritems():
             inode_count = len(inodes)
             if inode_count < 2:
                 continue
-            fies = set()
+            if sample_class == SAMPLE_HOLE:
+                # Nothing is allocated, there is nothing to share
+                continue
+            # These were compared when they were last updated
+            if not any(inode.has_updates for inode in inodes):
+                continue
+            if reader.throttle is not None:
+                reader.throttle.pause()
+            # Inodes that share all their extents form a cluster.
+            # Only one member of a cluster needs to be read, and the
+            # others are cloned along with it.
+            clusters = defaultdict(list)
+            inode_clusters = {}
             for inode in inodes:
-                try:
-                    pathb = inode.vol.live.lookup_one_path(inode)
-                except IOError as e:
-                    if e.errno != errno.ENOENT:
-                        raise
-                    sess.delete(inode)
-                    continue
-                with closing(fopenat(inode.vol.live.fd, pathb)) as rfile:
-                    fies.add(fiemap_hash_from_file(rfile))
+                if not inode.has_fiemap_hash:
+                    try:
+                        pathb = inode.vol.live.lookup_one_path(inode)
+                    except IOError as e:
+                        if e.errno != errno.ENOENT:
+                            raise
+                        forget_inode(sess, inode)
+                        continue
+                    with closing(fopenat(inode.vol.live.fd, pathb)) as rfile:
+                        inode.fiemap_hash_from_file(rfile)
+                if inode.fiemap_hash is None:
+                    # Unknown extents, the inode is a cluster of its own
+                    key = inode.vol_id, inode.ino
+                else:
+                    key = inode.fiemap_hash
+                clusters[key].append(inode)
+                inode_clusters[inode] = key
 
-            if len(fies) < 2:
+            if len(clusters) < 2:
                 continue
 
             files = []
@@ -412,7 +965,20 @@ def dedup_tracked1(sess, tt, ofile_reserved, query, fs):
             # For description only
             fd_names = {}
             fd_inodes = {}
+            fd_clusters = {}
+            # ctime and mtime when the file was opened
+            fd_times = {}
             by_hash = defaultdict(list)
+            # Files whose digest came from the database
+            cached_fds = set()
+            # Files whose stored digest matched their contents as of
+            # opening them, cached or computed by this pass
+            fresh_fds = set()
+            # Files whose digest came from the csum tree
+            csum_fds = set()
+            # Files whose equality with the rest of their by_hash group
+            # was checked byte for byte (zeroes or lockstep comparison)
+            verified_fds = set()
 
             # XXX I have no justification for doubling inode_count
             ofile_req = 2 * inode_count + ofile_reserved
@@ -440,7 +1006,7 @@ def dedup_tracked1(sess, tt, ofile_reserved, query, fs):
                     path = fsdecode(pathb)
                 except IOError as e:
                     if e.errno == errno.ENOENT:
-                        sess.delete(inode)
+                        forget_inode(sess, inode)
                         continue
                     raise
                 try:
@@ -466,28 +1032,171 @@ def dedup_tracked1(sess, tt, ofile_reserved, query, fs):
                 # Gets re-checked below (tell and fstat).
                 fd = afile.fileno()
                 fd_inodes[fd] = inode
+                fd_clusters[fd] = inode_clusters[inode]
                 fd_names[fd] = path
+                fd_times[fd] = change_times_ns(fd)
                 files.append(afile)
                 fds.append(fd)
 
+            def stamp_digests():
+                # Locking and cloning change the ctime; digests stay
+                # fresh until the next change after this one, unless
+                # the data changed since the file was opened.
+                for fd in fresh_fds:
+                    inode = fd_inodes[fd]
+                    if inode.digest is None:
+                        continue
+                    ctime, mtime = change_times_ns(fd)
+                    if mtime == fd_times[fd][1]:
+                        inode.digest_ctime = ctime
+                    else:
+                        inode.set_digest(None)
+
             with ExitStack() as stack:
                 for afile in files:
                     stack.enter_context(closing(afile))
-                # Enter this context last
-                immutability = stack.enter_context(ImmutableFDs(fds))
+                # Runs once the files are unlocked, before closing them
+                stack.callback(stamp_digests)
+                if device_queues is not None:
+                    group_map = stack.enter_context(
+                        closing(device_queues.for_fds(fds))).map
+                else:
+                    group_map = hash_map
 
+                # Files are hashed before being locked, with reads that
+                # wait for the throttle; what the cloning relies on is
+                # checked again under the lock.
                 # With a false positive, some kind of cmp pass that compares
                 # all files at once might be more efficient that hashing.
+                digests = {}
+                to_hash = []
+                to_check_zero = []
+                # Files that were found to only contain zeroes
+                zero_fds = []
+                # The cluster member that gets read for each cluster,
+                # and the members that take its digest
+                cluster_reps = {}
+                followers = {}
                 for afile in files:
                     fd = afile.fileno()
                     inode = fd_inodes[fd]
-                    if fd in immutability.fds_in_write_use:
+                    if sample_class == SAMPLE_ZERO:
+                        to_check_zero.append(fd)
+                    elif inode.has_fresh_digest(fd_times[fd][0]):
+                        digests[fd] = inode.digest
+                        cached_fds.add(fd)
+                        fresh_fds.add(fd)
+                        cluster_reps.setdefault(fd_clusters[fd], fd)
+                    else:
+                        to_hash.append(fd)
+                # Checking for zeroes doesn't read holes or hash anything;
+                # files that fail the check are hashed as usual.
+                for fd, is_zero in zip(
+                    to_check_zero, group_map(reader.is_zero, to_check_zero)
+                ):
+                    if is_zero:
+                        digests[fd] = ZERO_DIGEST
+                        zero_fds.append(fd)
+                    else:
+                        to_hash.append(fd)
+                for fd in to_hash:
+                    rep = cluster_reps.setdefault(fd_clusters[fd], fd)
+                    if rep != fd:
+                        followers[fd] = rep
+                to_hash = [fd for fd in to_hash if fd not in followers]
+                # Stored checksums can stand in for hashing, if every
+                # file has them; the data still gets compared.
+                if fingerprinter is not None and to_hash:
+                    fingerprints = {}
+                    for fd in to_hash + list(cached_fds):
+                        inode = fd_inodes[fd]
+                        fingerprint = fingerprinter.fingerprint(
+                            inode.vol.live.fd, inode.ino, size)
+                        if fingerprint is None:
+                            break
+                        fingerprints[fd] = fingerprint
+                    else:
+                        digests.update(fingerprints)
+                        csum_fds.update(fingerprints)
+                        to_hash = []
+                # Small groups are compared under the lock instead,
+                # with no hashing and no second read to verify
+                to_partition = []
+                if not cached_fds and len(to_hash) <= MAX_LOCKSTEP_FILES:
+                    to_partition = to_hash
+                else:
+                    digests.update(progressive_hash(
+                        reader, to_hash, size, group_map,
+                        keep_singletons=bool(cached_fds), elevator=elevator))
+
+                if use_extent_same:
+                    # The kernel compares the data under its own locks
+                    fds_in_write_use = ()
+                    locked_reader = reader
+                    verified_fds.update(zero_fds)
+                else:
+                    # Enter this context last
+                    immutability = stack.enter_context(
+                        ImmutableFDs(fds, proc_index))
+                    fds_in_write_use = immutability.fds_in_write_use
+                    # Don't wait for the throttle while holding
+                    # the files locked
+                    locked_reader = reader.locked()
+                for fd in fds:
+                    if fd in fds_in_write_use:
                         tt.notify('File %r is in use, skipping' % fd_names[fd])
-                        query.skipped.append(inode)
+                        query.skipped.append(fd_inodes[fd])
+                        digests.pop(fd, None)
+                        followers.pop(fd, None)
+                        fresh_fds.discard(fd)
+                to_partition = [
+                    fd for fd in to_partition if fd not in fds_in_write_use]
+                if not use_extent_same:
+                    # The files may have changed since they were checked
+                    zero_fds = [fd for fd in zero_fds if fd in digests]
+                    for fd, is_zero in zip(
+                        zero_fds, group_map(locked_reader.is_zero, zero_fds)
+                    ):
+                        if is_zero:
+                            verified_fds.add(fd)
+                        else:
+                            del digests[fd]
+                            query.skipped.append(fd_inodes[fd])
+                if elevator:
+                    layouts = dict(
+                        (fd, ExtentLayout(fd)) for fd in to_partition)
+                else:
+                    layouts = None
+                # Files that are left out have no duplicate
+                for i, cls in enumerate(locked_reader.partition(
+                    to_partition, group_map, layouts)
+                ):
+                    for fd in cls:
+                        digests[fd] = 'lockstep-%d' % i
+                        verified_fds.add(fd)
+                for fd, rep in followers.iteritems():
+                    if rep not in digests:
+                        continue
+                    # Check the stored extent hash against the live files
+                    if not same_extents(fd, rep):
+                        query.skipped.append(fd_inodes[fd])
+                        continue
+                    digests[fd] = digests[rep]
+                    if rep in cached_fds:
+                        cached_fds.add(fd)
+                        fd_inodes[fd].set_digest(digests[rep])
+                        fresh_fds.add(fd)
+                    if rep in csum_fds:
+                        csum_fds.add(fd)
+                    if rep in verified_fds:
+                        verified_fds.add(fd)
+
+                for afile in files:
+                    fd = afile.fileno()
+                    if fd not in digests:
                         continue
-                    hasher = hashlib.sha1()
-                    for buf in iter(lambda: afile.read(BUFSIZE), b''):
-                        hasher.update(buf)
+                    inode = fd_inodes[fd]
+                    digest = digests[fd]
 
                     # Gets rid of a race condition
                     st = os.fstat(fd)
@@ -498,22 +1207,37 @@ def dedup_tracked1(sess, tt, ofile_reserved, query, fs):
                         query.skipped.append(inode)
                         continue
 
-                    size1 = afile.tell()
+                    # The files are immutable while we hold them,
+                    # or extent-same will check everything anyway
+                    size1 = st.st_size
                     if size1 != size:
                         if size1 < inode.vol.size_cutoff:
                             # if we didn't delete this inode, it would cause
                             # spurious comm groups in all future invocations.
-                            sess.delete(inode)
+                            forget_inode(sess, inode)
                         else:
                             query.skipped.append(inode)
                         continue
 
-                    by_hash[hasher.digest()].append(afile)
-                    tt.update(fhash=None)
+                    if not (
+                        fd in cached_fds or fd in verified_fds
+                        or fd in csum_fds
+                    ):
+                        inode.set_digest(digest)
+                        fresh_fds.add(fd)
+                        tt.update(fhash=None)
+                    by_hash[digest].append(afile)
 
                 for fileset in by_hash.itervalues():
                     if len(fileset) < 2:
                         continue
+                    # Take the source from the largest cluster; the
+                    # members that already share its extents aren't read.
+                    cluster_sizes = defaultdict(int)
+                    for afile in fileset:
+                        cluster_sizes[fd_clusters[afile.fileno()]] += 1
+                    fileset.sort(key=lambda afile: -cluster_sizes[
+                        fd_clusters[afile.fileno()]])
                     sfile = fileset[0]
                     sfd = sfile.fileno()
                     sdesc = fd_inodes[sfd].vol.live.describe_path(
@@ -523,20 +1247,102 @@ def dedup_tracked1(sess, tt, ofile_reserved, query, fs):
                     if False:
                         defragment(sfd)
                     dfiles = fileset[1:]
+                    if elevator:
+                        # Compare with the files in disk order
+                        dfiles.sort(key=lambda dfile: ExtentLayout(
+                            dfile.fileno()).physical(0))
                     dfiles_successful = []
+                    if use_extent_same:
+                        dfds = [
+                            dfile.fileno() for dfile in dfiles
+                            if not same_extents(dfile.fileno(), sfd)]
+                        deduped, errors = extent_same(sfd, dfds, size)
+                        for dfile in dfiles:
+                            dfd = dfile.fileno()
+                            if dfd not in deduped:
+                                continue
+                            ddesc = fd_inodes[dfd].vol.live.describe_path(
+                                fd_names[dfd])
+                            space_gain += deduped[dfd]
+                            tt.update(space_gain=space_gain)
+                            if (
+                                errors.get(dfd) == errno.EINVAL
+                                and deduped[dfd]
+                                and size - deduped[dfd]
+                                < os.fstatvfs(sfd).f_bsize
+                            ):
+                                # Older kernels don't share a tail
+                                # that isn't block-aligned
+                                tt.notify(
+                                    'Deduplicated all but the last '
+                                    '%d bytes:\n- %r\n- %r' % (
+                                        size - deduped[dfd], sdesc, ddesc))
+                                dfiles_successful.append(dfile)
+                                fd_inodes[dfd].fiemap_hash = None
+                                continue
+                            if dfd in errors:
+                                # Not a difference, keep the digests
+                                tt.notify(
+                                    'Could not deduplicate %r %r: %s' % (
+                                        sdesc, ddesc,
+                                        os.strerror(errors[dfd])))
+                                if deduped[dfd]:
+                                    fd_inodes[dfd].fiemap_hash = None
+                                continue
+                            if deduped[dfd] == size:
+                                tt.notify(
+                                    'Deduplicated:\n- %r\n- %r'
+                                    % (sdesc, ddesc))
+                                dfiles_successful.append(dfile)
+                                fd_inodes[dfd].fiemap_hash = None
+                                continue
+                            # The files changed or a digest was stale
+                            tt.notify(
+                                'Files differ after %d bytes: %r %r'
+                                % (deduped[dfd], sdesc, ddesc))
+                            fd_inodes[sfd].set_digest(None)
+                            fd_inodes[dfd].set_digest(None)
+                            if deduped[dfd]:
+                                fd_inodes[dfd].fiemap_hash = None
+                        dfiles = ()
+                    # Live extents of the member of each cluster that
+                    # compared equal to sfile, before it was cloned.
+                    # The stored extent hash may be stale, so other
+                    # members only skip the comparison if their live
+                    # extents are the same.
+                    compared = {}
                     for dfile in dfiles:
                         dfd = dfile.fileno()
                         ddesc = fd_inodes[dfd].vol.live.describe_path(
                             fd_names[dfd])
-                        if not cmp_files(sfile, dfile):
-                            # Probably a bug since we just used a crypto hash
-                            tt.notify('Files differ: %r %r' % (sdesc, ddesc))
-                            assert False, (sdesc, ddesc)
+                        dcluster = fd_clusters[dfd]
+                        if same_extents(dfd, sfd):
+                            # Already shares the source's extents
                             continue
+                        dextents = placed_extents(dfd)
+                        if not (
+                            sfd in verified_fds and dfd in verified_fds
+                            or compared.get(dcluster) == dextents
+                        ):
+                            if not cmp_files(sfile, dfile, locked_reader):
+                                tt.notify(
+                                    'Files differ: %r %r' % (sdesc, ddesc))
+                                # A digest was stale, checksums collided,
+                                # or the files were written to between
+                                # hashing and locking.  Look at them
+                                # again next time.
+                                for fd in sfd, dfd:
+                                    fd_inodes[fd].set_digest(None)
+                                    if fd_inodes[fd] not in query.skipped:
+                                        query.skipped.append(fd_inodes[fd])
+                                continue
+                            compared.setdefault(dcluster, dextents)
                         if clone_data(dest=dfd, src=sfd, check_first=True):
                             tt.notify(
                                 'Deduplicated:\n- %r\n- %r' % (sdesc, ddesc))
                             dfiles_successful.append(dfile)
+                            # Now shares the source's extents
+                            fd_inodes[dfd].fiemap_hash = None
                             space_gain += size
                             tt.update(space_gain=space_gain)
                         elif False: